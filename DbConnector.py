@@ -1,4 +1,56 @@
+import os
+import threading
+from contextlib import contextmanager
+
 from pymongo import MongoClient, version
+from pymongo.write_concern import WriteConcern
+
+from instrumentation import CommandRecorder
+
+# Settings that can be given with environment variables instead of arguments, with their defaults
+ENVIRONMENT = {
+    "DATABASE": ("MONGO_DATABASE", "my_db"),
+    "HOST": ("MONGO_HOST", "tdt4225-21.idi.ntnu.no"),
+    "USER": ("MONGO_USER", "mongo"),
+    "PASSWORD": ("MONGO_PASSWORD", "mongo"),
+    "max_pool_size": ("MONGO_MAX_POOL_SIZE", None),
+    "min_pool_size": ("MONGO_MIN_POOL_SIZE", None),
+    "compressors": ("MONGO_COMPRESSORS", None),
+    "read_preference": ("MONGO_READ_PREFERENCE", None),
+    "connect_timeout_ms": ("MONGO_CONNECT_TIMEOUT_MS", None),
+    "server_selection_timeout_ms": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", None),
+    "socket_timeout_ms": ("MONGO_SOCKET_TIMEOUT_MS", None),
+    "bulk_write_concern": ("MONGO_BULK_WRITE_CONCERN", None),
+}
+
+# MongoClient keyword for every connection setting
+CLIENT_OPTIONS = {
+    "max_pool_size": "maxPoolSize",
+    "min_pool_size": "minPoolSize",
+    "compressors": "compressors",
+    "read_preference": "readPreference",
+    "connect_timeout_ms": "connectTimeoutMS",
+    "server_selection_timeout_ms": "serverSelectionTimeoutMS",
+    "socket_timeout_ms": "socketTimeoutMS",
+}
+
+
+def parse_write_concern(value):
+    """Parse a write concern like "w=1,j=false" into WriteConcern keyword arguments."""
+    if value is None or isinstance(value, dict):
+        return value
+    write_concern = {}
+    for option in value.split(","):
+        key, option_value = option.split("=")
+        key = key.strip()
+        option_value = option_value.strip()
+        if option_value.lower() in ("true", "false"):
+            write_concern[key] = option_value.lower() == "true"
+        elif option_value.isdigit():
+            write_concern[key] = int(option_value)
+        else:
+            write_concern[key] = option_value
+    return write_concern
 
 
 class DbConnector:
@@ -10,28 +62,124 @@ class DbConnector:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
     USER = "testuser" // This is the user you created and added privileges for
     PASSWORD = "test123" // The password you set for said user
+
+    Every setting that is not given falls back to its MONGO_* environment variable (see ENVIRONMENT)
+    and then to the defaults above. An empty USER connects without authentication.
+    Pool sizes, wire compression ("zstd,snappy,zlib"), read preference and timeouts are passed on to
+    MongoClient. bulk_write_concern (for example "w=1,j=false") is used by bulk_db() for loading.
+
+    With lazy=True the client is only created when it is first used. The connector is also a context
+    manager that closes the client on exit, so one client can be shared by DataLoader and Queries.
+
+    With instrument=True every command is recorded with pymongo's command monitoring and a summary per
+    tracked query is printed when the connection is closed. With explain=True the query plans are captured too.
+    quiet=True prints nothing, neither the connection messages nor that summary.
     """
 
     def __init__(self,
-                 DATABASE='my_db',
-                 HOST="tdt4225-21.idi.ntnu.no",
-                 USER="mongo",
-                 PASSWORD="mongo"):
-        uri = "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
-        # Connect to the databases
-        try:
-            self.client = MongoClient(uri)
-            self.db = self.client[DATABASE]
-        except Exception as e:
-            print("ERROR: Failed to connect to db:", e)
+                 DATABASE=None,
+                 HOST=None,
+                 USER=None,
+                 PASSWORD=None,
+                 instrument=False,
+                 explain=False,
+                 lazy=False,
+                 quiet=False,
+                 **options):
+        unknown = set(options) - set(ENVIRONMENT)
+        if unknown:
+            raise TypeError(f"Unknown connection settings: {', '.join(sorted(unknown))}")
+
+        settings = dict(options, DATABASE=DATABASE, HOST=HOST, USER=USER, PASSWORD=PASSWORD)
+        for name, (variable, default) in ENVIRONMENT.items():
+            if settings.get(name) is None:
+                settings[name] = os.environ.get(variable, default)
+        settings["bulk_write_concern"] = parse_write_concern(settings["bulk_write_concern"])
+        # Keep the settings so worker processes can open their own connectors
+        self.settings = settings
+        self.database_name = settings["DATABASE"]
+        self.quiet = quiet
+
+        self.recorder = CommandRecorder(explain=explain) if instrument or explain else None
+        self._client = None
+        # Queries on a thread pool can all use a lazy connector for the first time at once
+        self._connect_lock = threading.Lock()
+        if not lazy:
+            self.connect()
+
+    def client_options(self):
+        """Keyword arguments for MongoClient built from the settings."""
+        options = {"host": self.settings["HOST"]}
+        if self.settings["USER"]:
+            options.update(username=self.settings["USER"], password=self.settings["PASSWORD"], authSource=self.database_name)
+        for name, keyword in CLIENT_OPTIONS.items():
+            value = self.settings.get(name)
+            if value is None:
+                continue
+            options[keyword] = int(value) if name.endswith(("_size", "_ms")) else value
+        if self.recorder is not None:
+            options["event_listeners"] = [self.recorder]
+        return options
+
+    def connect(self):
+        with self._connect_lock:
+            if self._client is not None:
+                return self._client
+            # Connect to the databases
+            try:
+                self._client = MongoClient(**self.client_options())
+            except Exception as e:
+                print("ERROR: Failed to connect to db:", e)
+                raise
 
         # get database information
-        print("You are connected to the database:", self.db.name)
-        print("-----------------------------------------------\n")
+        if not self.quiet:
+            print("You are connected to the database:", self.database_name)
+            print("-----------------------------------------------\n")
+        return self._client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else self.connect()
+
+    @property
+    def db(self):
+        return self.client[self.database_name]
+
+    def bulk_db(self):
+        """The database with the bulk write concern applied, for loading data."""
+        write_concern = self.settings["bulk_write_concern"]
+        if not write_concern:
+            return self.db
+        return self.db.with_options(write_concern=WriteConcern(**write_concern))
+
+    @contextmanager
+    def track(self, label):
+        """Attribute the commands sent inside the block to label when instrumentation is on."""
+        if self.recorder is None:
+            yield
+            return
+
+        with self.recorder.track(label):
+            yield
+        if self.recorder.explain:
+            self.recorder.explain_commands(self.db, label)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
 
     def close_connection(self):
+        if self.recorder is not None and not self.quiet:
+            self.recorder.print_summary()
+        if self._client is None:
+            return
         # close the cursor
         # close the DB connection
-        self.client.close()
-        print("\n-----------------------------------------------")
-        print("Connection to %s-db is closed" % self.db.name)
+        self._client.close()
+        self._client = None
+        if not self.quiet:
+            print("\n-----------------------------------------------")
+            print("Connection to %s-db is closed" % self.database_name)
@@ -0,0 +1,149 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+from datetime import datetime
+
+from tabulate import tabulate
+
+from DbConnector import DbConnector
+from generate_dataset import generate_dataset
+from insert import DataLoader
+from queries import Queries
+
+QUERIES = ["query_one", "query_two", "query_three", "query_four", "query_five", "query_six",
+           "query_seven", "query_eight", "query_nine", "query_ten", "query_eleven"]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children, in MB (ru_maxrss is in KB on Linux)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+class Benchmark:
+    """
+    Times loading a dataset with DataLoader and running every Queries.query_* against a local mongod.
+
+    Every step records its wall time, the number of documents it wrote (for the load steps),
+    documents per second and the peak RSS so far. Output of the loader and the queries is discarded.
+    """
+
+    def __init__(self, db_connector, data_dir, loader_options=None, query_options=None):
+        self.connection = db_connector
+        self.data_dir = data_dir
+        self.loader_options = loader_options or {}
+        self.query_options = query_options or {}
+        self.results = []
+
+    def measure(self, name, function, documents=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            seconds = time.perf_counter() - start
+
+        if callable(documents):
+            documents = documents(result)
+        self.results.append({
+            "name": name,
+            "seconds": seconds,
+            "documents": documents,
+            "documents_per_second": documents / seconds if documents and seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+        print(f"{name}: {seconds:.3f} s")
+
+    def run(self):
+        loader = DataLoader(self.connection, data_dir=self.data_dir, **self.loader_options)
+        loader.drop_collections()
+
+        self.measure("load_users", loader.load_users,
+                     documents=lambda _: loader.users_collection.count_documents({}))
+        self.measure("load_activities", loader.load_activities,
+                     documents=lambda totals: totals["activities"] + totals["trackpoints"])
+        self.measure("create_indexes", loader.create_indexes)
+
+        program = Queries(self.connection, **self.query_options)
+        for query in QUERIES:
+            self.measure(query, getattr(program, query))
+
+        return self.results
+
+    def save(self, path, config):
+        with open(path, "w") as output:
+            json.dump({
+                "timestamp": datetime.now().isoformat(),
+                "platform": platform.platform(),
+                "config": config,
+                "results": self.results,
+            }, output, indent=2)
+        print(f"Results written to {path}")
+
+
+def compare(old_path, new_path):
+    """Print the wall times of two result files side by side."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old = {result["name"]: result for result in json.load(old_file)["results"]}
+        new = {result["name"]: result for result in json.load(new_file)["results"]}
+
+    table = []
+    for name, result in new.items():
+        if name not in old:
+            continue
+        speedup = old[name]["seconds"] / result["seconds"] if result["seconds"] else None
+        table.append((name, old[name]["seconds"], result["seconds"], speedup))
+    print(tabulate(table, headers=["Step", "Old (s)", "New (s)", "Speedup"], floatfmt=".3f"))
+
+
+def main(args):
+    config = vars(args).copy()
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="geolife_")
+        generate_dataset(data_dir, args.users, args.activities, args.points, seed=args.seed)
+    elif not os.path.exists(os.path.join(data_dir, "labeled_ids.txt")):
+        generate_dataset(data_dir, args.users, args.activities, args.points, seed=args.seed)
+
+    program = None
+    try:
+        program = Benchmark(
+            DbConnector(DATABASE=args.database, HOST=args.host, USER=""),
+            data_dir,
+            loader_options={"workers": args.workers, "trackpoint_layout": args.layout, "timeseries": args.timeseries,
+                            "pipeline_writers": args.pipeline_writers},
+            query_options={"trackpoint_layout": args.layout},
+        )
+        program.run()
+        print(tabulate([(r["name"], r["seconds"], r["documents_per_second"], r["peak_rss_mb"]) for r in program.results],
+                       headers=["Step", "Seconds", "Documents/s", "Peak RSS (MB)"], floatfmt=".3f"))
+        program.save(args.output, config)
+    finally:
+        if program:
+            program.connection.close_connection()
+
+    if args.compare:
+        compare(args.compare, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading and querying a synthetic Geolife dataset")
+    parser.add_argument("-data-dir", default=None, help="Dataset to use, generated if it does not exist (default: a temporary directory)")
+    parser.add_argument("-users", type=int, default=10, help="Number of generated users")
+    parser.add_argument("-activities", type=int, default=20, help="Number of generated activities per user")
+    parser.add_argument("-points", type=int, default=500, help="Average number of generated points per activity")
+    parser.add_argument("-seed", type=int, default=0, help="Random seed for the generator")
+    parser.add_argument("-host", default="localhost", help="MongoDB server without authentication")
+    parser.add_argument("-database", default="geolife_benchmark", help="Database to load into, it is dropped first")
+    parser.add_argument("-workers", type=int, default=1, help="Number of loader worker processes")
+    parser.add_argument("-layout", choices=["points", "buckets"], default="points", help="How trackpoints are stored")
+    parser.add_argument("-timeseries", action="store_true", help="Store trackpoints in a time-series collection")
+    parser.add_argument("-pipeline-writers", type=int, default=0, help="Number of loader writer threads (0 writes inline)")
+    parser.add_argument("-output", default="benchmark_results.json", help="File to write the results to")
+    parser.add_argument("-compare", default=None, help="Earlier results file to compare against")
+    main(parser.parse_args())
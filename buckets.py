@@ -0,0 +1,91 @@
+import numpy as np
+from bson import Binary
+
+# Fields of a trackpoint that are stored as parallel arrays in a bucket
+BUCKET_FIELDS = ["lat", "lon", "altitude", "date_days", "date_from"]
+
+
+def pack(values, dtype):
+    return Binary(np.asarray(values, dtype=dtype).tobytes())
+
+
+def unpack(data, dtype):
+    return np.frombuffer(data, dtype=dtype)
+
+
+def build_buckets(df, date_from, user_id, activity_id, bucket_size=None, packed=False):
+    """
+    Build the bucket documents for one activity.
+
+    Every bucket holds up to bucket_size consecutive points (all of them if bucket_size is None) as
+    parallel arrays of lat, lon, altitude, date_days and date_from. With packed=True the arrays are
+    stored as little-endian binary, float64 for the coordinates and int64 milliseconds for date_from.
+    """
+    bucket_size = bucket_size or max(1, len(df))
+    lats = df[0].to_numpy(dtype=float)
+    lons = df[1].to_numpy(dtype=float)
+    altitudes = df[3].to_numpy(dtype=float)
+    date_days = df[4].to_numpy(dtype=float)
+    dates = date_from.to_numpy(dtype="datetime64[ms]")
+
+    buckets = []
+    for chunk, start in enumerate(range(0, len(df), bucket_size)):
+        end = start + bucket_size
+        bucket = {
+            "user_id": user_id,
+            "activity_id": activity_id,
+            "chunk": chunk,
+            "count": len(lats[start:end]),
+            "start_date": dates[start].item(),
+            "end_date": dates[start:end][-1].item(),
+            "min_lat": float(lats[start:end].min()),
+            "max_lat": float(lats[start:end].max()),
+            "min_lon": float(lons[start:end].min()),
+            "max_lon": float(lons[start:end].max()),
+            "packed": packed,
+        }
+        if packed:
+            bucket.update({
+                "lat": pack(lats[start:end], "<f8"),
+                "lon": pack(lons[start:end], "<f8"),
+                "altitude": pack(altitudes[start:end], "<f8"),
+                "date_days": pack(date_days[start:end], "<f8"),
+                "date_from": pack(dates[start:end].astype("int64"), "<i8"),
+            })
+        else:
+            bucket.update({
+                "lat": lats[start:end].tolist(),
+                "lon": lons[start:end].tolist(),
+                "altitude": altitudes[start:end].tolist(),
+                "date_days": date_days[start:end].tolist(),
+                "date_from": dates[start:end].tolist(),
+            })
+        buckets.append(bucket)
+    return buckets
+
+
+def decode_bucket(bucket):
+    """Return the arrays of a bucket as NumPy arrays, with date_from as datetime64[ms]."""
+    if bucket.get("packed"):
+        arrays = {field: unpack(bucket[field], "<f8") for field in BUCKET_FIELDS if field in bucket and field != "date_from"}
+        if "date_from" in bucket:
+            arrays["date_from"] = unpack(bucket["date_from"], "<i8").astype("datetime64[ms]")
+        return arrays
+
+    arrays = {field: np.array(bucket[field], dtype=float) for field in BUCKET_FIELDS if field in bucket and field != "date_from"}
+    if "date_from" in bucket:
+        arrays["date_from"] = np.array(bucket["date_from"], dtype="datetime64[ms]")
+    return arrays
+
+
+def points_in_polygon(lats, lons, polygon):
+    """Vectorized ray casting test of which points lie inside a polygon of (lon, lat) pairs."""
+    inside = np.zeros(len(lats), dtype=bool)
+    ring = list(polygon)
+    for (lon1, lat1), (lon2, lat2) in zip(ring, ring[1:] + ring[:1]):
+        if lat1 == lat2:
+            continue
+        crosses = (lat1 > lats) != (lat2 > lats)
+        lon_at_lat = lon1 + (lats - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        inside ^= crosses & (lons < lon_at_lat)
+    return inside
@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+from datetime import datetime
+from pprint import pprint
+
+import numpy as np
+import pandas as pd
+
+from buckets import points_in_polygon
+from DbConnector import DbConnector
+from queries import QUERY_METHODS, Queries, haversine_np, parse_queries, run_queries
+from query_cache import get_dataset_version
+from query_rows import (AltitudeGain, AverageActivities, BusiestYears, CollectionCount, Distance, InvalidActivities,
+                        ModeActivities, MostUsedMode, QueryPrinter, RegionUser, TaxiUser, UserActivities)
+
+# Fields of every trackpoint that are exported, next to the index of its activity
+TRACKPOINT_FIELDS = ["lat", "lon", "altitude", "date_from"]
+
+
+def save_columns(directory, columns):
+    os.makedirs(directory, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(directory, name + ".npy"), values)
+
+
+def load_columns(directory):
+    """Memory-map every column in directory, so nothing is read until it is used."""
+    return {name[:-4]: np.load(os.path.join(directory, name), mmap_mode="r")
+            for name in sorted(os.listdir(directory)) if name.endswith(".npy")}
+
+
+def export_dataset(db_connector, output_dir, trackpoint_layout="points"):
+    """
+    Export the users, activities and trackpoints collections to NumPy files that LocalQueries can answer queries from.
+
+    Users and activities are stored as one .npy file per column. Trackpoints are partitioned per user in
+    trackpoints/<user_id>/, sorted by activity and time, with the index of their activity in the activities
+    columns instead of its ObjectId. Trackpoints are read with Queries.iter_activity_points, so both
+    layouts can be exported. The dataset version is written to metadata.json.
+    """
+    db = db_connector.db
+    reader = Queries(db_connector, trackpoint_layout=trackpoint_layout)
+
+    users = list(db["users"].find({}, {"_id": 0, "user_id": 1, "has_labels": 1}).sort("user_id", 1))
+    save_columns(os.path.join(output_dir, "users"), {
+        "user_id": np.array([user["user_id"] for user in users], dtype=str),
+        "has_labels": np.array([user["has_labels"] for user in users], dtype=bool),
+    })
+
+    activities = list(db["activities"].find(
+        {}, {"user_id": 1, "transportation_mode": 1, "start_date_time": 1, "end_date_time": 1, "altitude_gained": 1}
+    ).sort("_id", 1))
+    save_columns(os.path.join(output_dir, "activities"), {
+        "id": np.array([str(activity["_id"]) for activity in activities], dtype=str),
+        "user_id": np.array([activity["user_id"] for activity in activities], dtype=str),
+        # Activities without a label get an empty string, object arrays cannot be memory-mapped
+        "transportation_mode": np.array([activity["transportation_mode"] or "" for activity in activities], dtype=str),
+        "start_date_time": np.array([activity["start_date_time"] for activity in activities], dtype="datetime64[ms]"),
+        "end_date_time": np.array([activity["end_date_time"] for activity in activities], dtype="datetime64[ms]"),
+        "altitude_gained": np.array([activity["altitude_gained"] for activity in activities], dtype=float),
+    })
+    activity_index = {activity["_id"]: index for index, activity in enumerate(activities)}
+    user_activities = {}
+    for activity in activities:
+        user_activities.setdefault(activity["user_id"], []).append(activity["_id"])
+
+    trackpoint_count = 0
+    for user_id, activity_ids in sorted(user_activities.items()):
+        indexes, chunks = [], []
+        # activity_id is indexed in both layouts, user_id is not
+        query = {"activity_id": {"$in": activity_ids}}
+        for activity_id, _, arrays in reader.iter_activity_points(query, TRACKPOINT_FIELDS):
+            indexes.append(np.full(len(arrays["lat"]), activity_index[activity_id], dtype=np.int64))
+            chunks.append(arrays)
+        if not chunks:
+            continue
+        columns = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in TRACKPOINT_FIELDS}
+        columns["activity"] = np.concatenate(indexes)
+        save_columns(os.path.join(output_dir, "trackpoints", user_id), columns)
+        trackpoint_count += len(columns["activity"])
+
+    with open(os.path.join(output_dir, "metadata.json"), "w") as metadata:
+        json.dump({"dataset_version": get_dataset_version(db), "exported_at": datetime.now().isoformat(),
+                   "database": db_connector.database_name}, metadata, indent=2)
+    print(f"Exported {len(users)} users, {len(activities)} activities and {trackpoint_count} trackpoints to {output_dir}")
+
+
+class LocalQueries(QueryPrinter):
+    """
+    Answers queries 1-11 like Queries, but from a dataset exported with export_dataset instead of MongoDB.
+
+    Activities are loaded into a pandas DataFrame, trackpoints are memory-mapped per user and
+    processed with vectorized NumPy, so query 7 only touches the partition of one user.
+    The iter_query_* methods yield the same rows as those of Queries, so the output is the same too.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, "metadata.json")) as metadata:
+            self.metadata = json.load(metadata)
+        self.users = load_columns(os.path.join(data_dir, "users"))
+        self.activities = pd.DataFrame({name: np.asarray(values) for name, values in
+                                        load_columns(os.path.join(data_dir, "activities")).items()})
+        trackpoints_dir = os.path.join(data_dir, "trackpoints")
+        self.trackpoint_users = sorted(os.listdir(trackpoints_dir)) if os.path.isdir(trackpoints_dir) else []
+
+    def trackpoints(self, user_id):
+        return load_columns(os.path.join(self.data_dir, "trackpoints", user_id))
+
+    def iter_trackpoints(self):
+        for user_id in self.trackpoint_users:
+            yield user_id, self.trackpoints(user_id)
+
+    def iter_query_one(self):
+        """How many users, activities and trackpoints are there in the dataset"""
+        yield CollectionCount("Users", len(self.users["user_id"]))
+        yield CollectionCount("Activities", len(self.activities))
+        yield CollectionCount("Trackpoints", sum(len(points["activity"]) for _, points in self.iter_trackpoints()))
+
+    def iter_query_two(self):
+        """Find the average number of activities per user."""
+        yield AverageActivities(float(self.activities.groupby("user_id").size().mean()))
+
+    def iter_query_three(self):
+        """Find the top 20 users with the highest number of activities."""
+        counts = self.activities.groupby("user_id").size().reset_index(name="count")
+        top_users = counts.sort_values(["count", "user_id"], ascending=[False, True]).head(20)
+        for user, count in top_users.itertuples(index=False):
+            yield UserActivities(user, int(count))
+
+    def iter_query_four(self):
+        """Find all users who have taken a taxi."""
+        for user in np.unique(self.activities.loc[self.activities["transportation_mode"] == "taxi", "user_id"]):
+            yield TaxiUser(str(user))
+
+    def iter_query_five(self):
+        """Count the activities per transportation mode."""
+        labeled = self.activities[self.activities["transportation_mode"] != ""]
+        counts = labeled.groupby("transportation_mode").size().reset_index(name="count")
+        counts = counts.sort_values(["count", "transportation_mode"], ascending=[False, True])
+        for mode, count in counts.itertuples(index=False):
+            yield ModeActivities(mode, int(count))
+
+    def iter_query_six(self):
+        """Find the year with the most activities and the year with the most recorded hours."""
+        years = self.activities["start_date_time"].dt.year
+        hours = (self.activities["end_date_time"] - self.activities["start_date_time"]).dt.total_seconds() / 3600
+        activities_per_year = years.value_counts()
+        hours_per_year = hours.groupby(years).sum()
+        yield BusiestYears(int(activities_per_year.idxmax()), int(activities_per_year.max()),
+                           int(hours_per_year.idxmax()), float(hours_per_year.max()))
+
+    def iter_query_seven(self, user_id="112", transportation_mode="walk", start_year=2008, end_year=2008):
+        """Find the total distance (in km) walked in 2008, by user with id=112."""
+        start, end = np.datetime64(f"{start_year}-01-01"), np.datetime64(f"{end_year + 1}-01-01")
+        activities = self.activities
+        selected = activities.index[
+            (activities["user_id"] == user_id) & (activities["transportation_mode"] == transportation_mode)
+            & (activities["start_date_time"] >= start) & (activities["start_date_time"] < end)
+            & (activities["end_date_time"] >= start) & (activities["end_date_time"] < end)
+        ]
+
+        total_distance = 0
+        if len(selected) and user_id in self.trackpoint_users:
+            points = self.trackpoints(user_id)
+            activity = np.asarray(points["activity"])
+            starts = np.searchsorted(activity, selected.to_numpy(), side="left")
+            ends = np.searchsorted(activity, selected.to_numpy(), side="right")
+            for first, last in zip(starts, ends):
+                lats, lons = points["lat"][first:last], points["lon"][first:last]
+                total_distance += float(haversine_np(lats[:-1], lons[:-1], lats[1:], lons[1:]).sum())
+
+        yield Distance(user_id, transportation_mode, start_year, end_year, total_distance)
+
+    def iter_query_eight(self):
+        """Find the top 20 users who have gained the most altitude, in meters."""
+        gained = (self.activities["altitude_gained"] * 0.3048).groupby(self.activities["user_id"]).sum()
+        for user, altitude in gained.sort_values(ascending=False, kind="stable").head(20).items():
+            yield AltitudeGain(user, float(altitude))
+
+    def iter_query_nine(self):
+        """Find the number of activities per user with two consecutive trackpoints more than 5 minutes apart."""
+        max_gap = np.timedelta64(5, "m")
+        for user_id, points in self.iter_trackpoints():
+            activity = np.asarray(points["activity"])
+            same_activity = activity[1:] == activity[:-1]
+            gaps = same_activity & (np.diff(points["date_from"]) > max_gap)
+            invalid_activities = len(np.unique(activity[1:][gaps]))
+            if invalid_activities:
+                yield InvalidActivities(user_id, invalid_activities)
+
+    def iter_query_ten(self, min_lat=39.916, min_lon=116.397, max_lat=39.917, max_lon=116.398, polygon=None):
+        """Find the users who have tracked an activity in the Forbidden City of Beijing (or any other region)."""
+        for user_id, points in self.iter_trackpoints():
+            lats, lons = np.asarray(points["lat"]), np.asarray(points["lon"])
+            if polygon is not None:
+                inside = points_in_polygon(lats, lons, polygon)
+            else:
+                inside = (lats >= min_lat) & (lats < max_lat) & (lons >= min_lon) & (lons < max_lon)
+            if inside.any():
+                yield RegionUser(user_id)
+
+    def iter_query_eleven(self):
+        """Find all users who have registered transportation_mode and their most used transportation_mode."""
+        labeled = self.activities[self.activities["transportation_mode"] != ""]
+        counts = labeled.groupby(["user_id", "transportation_mode"]).size().reset_index(name="count")
+        # Same tie-break as Queries: the highest count, then the greatest mode name
+        most_used = counts.sort_values(["user_id", "count", "transportation_mode"]).groupby("user_id").tail(1)
+        for user, mode, count in most_used.itertuples(index=False):
+            yield MostUsedMode(user, mode, int(count))
+
+    def query_print_samples(self):
+        print("\nInstance of User:")
+        pprint({name: values[0].item() for name, values in self.users.items()})
+
+        activities = self.activities[self.activities["transportation_mode"] != ""]
+        activity = activities.iloc[0]
+        print("\nInstance of Activity")
+        pprint(activity.to_dict())
+
+        points = self.trackpoints(activity["user_id"])
+        first = int(np.searchsorted(points["activity"], activity.name))
+        print("\nInstance of Trackpoint")
+        pprint({name: values[first].item() for name, values in points.items()})
+
+
+def main(args):
+    if args.export:
+        with DbConnector() as db_connector:
+            export_dataset(db_connector, args.dir, args.layout)
+        return
+
+    program = LocalQueries(args.dir)
+    print(f"Using the export of dataset version {program.metadata['dataset_version']} from {program.metadata['exported_at']}")
+    numbers = parse_queries(args.query)
+    if any(number not in QUERY_METHODS for number in numbers):
+        print("ERROR: Invalid query number")
+    elif len(numbers) == 1:
+        getattr(program, QUERY_METHODS[numbers[0]])()
+    else:
+        run_queries(program, None, numbers, args.workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the dataset to NumPy files and run the queries on them without MongoDB")
+    parser.add_argument("-dir", default="./columnar_dataset", help="Directory of the exported dataset")
+    parser.add_argument("-export", action="store_true", help="Export the collections from MongoDB to -dir")
+    parser.add_argument("-layout", choices=["points", "buckets"], default="points", help="How trackpoints are stored in MongoDB")
+    parser.add_argument("-query", default="all", help="Choose query: a number, a comma separated list or all")
+    parser.add_argument("-workers", type=int, default=None,
+                        help="Number of queries run at once (default: all). With 1 the rows are printed as they stream in")
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+# Header of every Geolife PLT file, the loader skips these lines
+PLT_HEADER = [
+    "Geolife trajectory",
+    "WGS 84",
+    "Altitude is in Feet",
+    "Reserved 3",
+    "0,2,255,My Track,0,0,2,8421376",
+    "0",
+]
+
+TRANSPORTATION_MODES = ["walk", "bike", "bus", "car", "taxi", "subway", "train", "airplane", "boat", "run"]
+
+# Days between the Excel/Delphi epoch used by the date_days column and the Unix epoch
+DATE_DAYS_OFFSET = 25569
+
+
+def date_days(date):
+    return (date - datetime(1970, 1, 1)).total_seconds() / 86400 + DATE_DAYS_OFFSET
+
+
+def generate_dataset(data_dir, users=10, activities=20, points=500, labeled_fraction=0.5,
+                     long_fraction=0.05, gap_fraction=0.2, seed=0):
+    """
+    Write a Geolife-shaped dataset: Data/<user>/Trajectory/*.plt, labels.txt for labeled users and labeled_ids.txt.
+
+    Every user gets `activities` trajectories of around `points` points around Beijing between 2007 and 2012.
+    A share of the trajectories is longer than the loader's trackpoint limit, a share has gaps of more
+    than 5 minutes, and every labeled user has a transportation mode for about half of their activities.
+    """
+    rng = random.Random(seed)
+    labeled_users = []
+
+    for user in range(users):
+        user_id = "%03d" % user
+        trajectory_dir = os.path.join(data_dir, "Data", user_id, "Trajectory")
+        os.makedirs(trajectory_dir, exist_ok=True)
+        labeled = rng.random() < labeled_fraction
+        labels = []
+
+        start = datetime(2007, 1, 1) + timedelta(seconds=rng.randrange(5 * 365 * 86400))
+        for _ in range(activities):
+            count = rng.randint(points // 2, points * 3 // 2)
+            if rng.random() < long_fraction:
+                count = rng.randint(2501, 4000)
+            has_gap = rng.random() < gap_fraction
+
+            lat, lon, altitude = 39.9 + rng.uniform(-0.2, 0.2), 116.4 + rng.uniform(-0.2, 0.2), rng.randint(0, 300)
+            time = start
+            lines = list(PLT_HEADER)
+            for point in range(count):
+                lat += rng.uniform(-0.0005, 0.0005)
+                lon += rng.uniform(-0.0005, 0.0005)
+                altitude = -777 if rng.random() < 0.05 else max(0, altitude + rng.randint(-5, 5))
+                lines.append(f"{lat:.6f},{lon:.6f},0,{altitude},{date_days(time):.10f},{time:%Y-%m-%d},{time:%H:%M:%S}")
+                if point < count - 1:
+                    time += timedelta(seconds=rng.choice([1, 2, 5, 10]))
+                    if has_gap and point == count // 2:
+                        time += timedelta(minutes=rng.randint(6, 60))
+
+            with open(os.path.join(trajectory_dir, f"{start:%Y%m%d%H%M%S}.plt"), "w") as plt_file:
+                plt_file.write("\r\n".join(lines) + "\r\n")
+
+            if labeled and rng.random() < 0.5:
+                labels.append(f"{start:%Y/%m/%d %H:%M:%S}\t{time:%Y/%m/%d %H:%M:%S}\t{rng.choice(TRANSPORTATION_MODES)}")
+
+            start = time + timedelta(hours=rng.randint(1, 72))
+
+        if labeled:
+            labeled_users.append(user_id)
+            with open(os.path.join(data_dir, "Data", user_id, "labels.txt"), "w") as label_file:
+                label_file.write("\n".join(["Start Time\tEnd Time\tTransportation Mode"] + labels) + "\n")
+
+    with open(os.path.join(data_dir, "labeled_ids.txt"), "w") as labeled_ids:
+        labeled_ids.write("\n".join(labeled_users) + "\n")
+
+    print(f"Generated {users} users with {activities} activities each in {data_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Geolife-shaped dataset")
+    parser.add_argument("-data-dir", default="./synthetic_dataset", help="Directory to write the dataset to")
+    parser.add_argument("-users", type=int, default=10, help="Number of users")
+    parser.add_argument("-activities", type=int, default=20, help="Number of activities per user")
+    parser.add_argument("-points", type=int, default=500, help="Average number of points per activity")
+    parser.add_argument("-seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    generate_dataset(args.data_dir, args.users, args.activities, args.points, seed=args.seed)
@@ -0,0 +1,133 @@
+import argparse
+
+from pymongo import ASCENDING, GEOSPHERE
+from tabulate import tabulate
+
+from DbConnector import DbConnector
+from instrumentation import command_filter, explain_command
+from queries import QUERY_METHODS, Queries
+
+
+# Indexes needed by the queries and the incremental loader, per collection.
+# They are built after a bulk load so the inserts do not have to maintain them.
+INDEXES = {
+    "users": [
+        {"keys": [("user_id", ASCENDING)], "name": "user_id", "unique": True},
+    ],
+    "activities": [
+        {"keys": [("user_id", ASCENDING), ("transportation_mode", ASCENDING), ("start_date_time", ASCENDING)],
+         "name": "user_id_transportation_mode_start_date_time"},
+        {"keys": [("transportation_mode", ASCENDING), ("user_id", ASCENDING)], "name": "transportation_mode_user_id"},
+        # Filtered on by the summary path of queries 9 and 10
+        {"keys": [("max_gap_seconds", ASCENDING)], "name": "max_gap_seconds"},
+        {"keys": [("bounding_box.min_lat", ASCENDING), ("bounding_box.max_lat", ASCENDING),
+                  ("bounding_box.min_lon", ASCENDING), ("bounding_box.max_lon", ASCENDING)], "name": "bounding_box"},
+    ],
+    "trackpoints": [
+        {"keys": [("activity_id", ASCENDING), ("date_from", ASCENDING)], "name": "activity_id_date_from"},
+        {"keys": [("location", GEOSPHERE)], "name": "location"},
+    ],
+    "trackpoint_buckets": [
+        {"keys": [("activity_id", ASCENDING), ("chunk", ASCENDING)], "name": "activity_id_chunk"},
+        {"keys": [("min_lat", ASCENDING), ("max_lat", ASCENDING), ("min_lon", ASCENDING), ("max_lon", ASCENDING)], "name": "bounding_box"},
+    ],
+    "user_stats": [
+        {"keys": [("activity_count", ASCENDING)], "name": "activity_count"},
+    ],
+    "manifest": [
+        {"keys": [("user_id", ASCENDING)], "name": "user_id"},
+    ],
+}
+
+class IndexManager:
+
+    def __init__(self, db_connector):
+        self.connection = db_connector
+        self.db = db_connector.db
+
+    def create_indexes(self):
+        """Create every declared index. Indexes that already exist are left as they are."""
+        for collection_name, indexes in INDEXES.items():
+            for index in indexes:
+                options = {key: value for key, value in index.items() if key != "keys"}
+                self.db[collection_name].create_index(index["keys"], **options)
+            print(f"{len(indexes)} indexes created for {collection_name}")
+
+    def drop_indexes(self):
+        for collection_name in INDEXES:
+            self.db[collection_name].drop_indexes()
+        print("All indexes have been dropped.")
+
+    def verify_indexes(self, trackpoint_layout="points"):
+        """
+        Run every query, explain the commands it sent and check that none of those with a filter does a COLLSCAN.
+
+        The queries run as they would on this database, so the summaries, user_stats or raw collections are
+        explained depending on what has been loaded. Commands without a filter aggregate over a whole collection
+        and are expected to scan it. Returns True if every filtered command is answered from an index.
+
+        The commands are only known once the queries have read their results, so every query runs in full.
+        That takes as long as running them normally, and on a database without summaries it streams the
+        whole trackpoints collection for query 9.
+        """
+        connector = DbConnector(**self.connection.settings, explain=True, lazy=True, quiet=True)
+        recorder = connector.recorder
+        queries = Queries(connector, trackpoint_layout=trackpoint_layout)
+        table = []
+        all_indexed = True
+        try:
+            for number, method in QUERY_METHODS.items():
+                if number == 13:
+                    continue
+                with recorder.track(method):
+                    for _ in getattr(queries, "iter_" + method)():
+                        pass
+
+            with recorder.paused():
+                for record in recorder.commands:
+                    if record["spec"] is None:
+                        continue
+                    filtered = bool(command_filter(record["spec"]))
+                    for stages in explain_command(connector.db, record["spec"]):
+                        uses_index = "COLLSCAN" not in stages
+                        all_indexed = all_indexed and (uses_index or not filtered)
+                        table.append((record["label"], record["command"], record["collection"],
+                                      " <- ".join(stages), uses_index if filtered else "no filter"))
+        finally:
+            connector.close_connection()
+
+        print(tabulate(table, headers=["Query", "Command", "Collection", "Plan", "Uses index"]))
+        return all_indexed
+
+
+def main(action, trackpoint_layout="points"):
+    program = None
+    try:
+        db_connector = DbConnector()
+
+        program = IndexManager(db_connector)
+
+        if action == "create":
+            program.create_indexes()
+        elif action == "drop":
+            program.drop_indexes()
+        elif action == "verify":
+            if not program.verify_indexes(trackpoint_layout):
+                print("WARNING: Some queries do a full collection scan")
+        else:
+            print("ERROR: Invalid action")
+
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if program:
+            program.connection.close_connection()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the indexes used by the queries")
+    parser.add_argument("-action", choices=["create", "drop", "verify"], default="create", help="Choose action. verify runs every query in full against the database")
+    parser.add_argument("-layout", choices=["points", "buckets"], default="points",
+                        help="Trackpoint layout the queries read when verifying")
+    args = parser.parse_args()
+    main(args.action, args.layout)
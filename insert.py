@@ -1,21 +1,306 @@
+import argparse
+import hashlib
 import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import bson
 import pandas as pd
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from tabulate import tabulate
+
+from buckets import build_buckets
 from DbConnector import DbConnector
-from datetime import datetime
+from indexes import IndexManager
+from queries import haversine_np
+from query_cache import bump_dataset_version
+from simplify import simplify_track
+
+
+# Number of header lines at the top of every PLT file
+PLT_HEADER_LINES = 6
+
+
+def count_track_points(path):
+    """
+    Count the trackpoints in a PLT file in a raw binary pass over its lines.
+
+    This is a lot cheaper than parsing the file with pandas, so oversized files can be skipped early.
+    Like pd.read_csv, the header lines are skipped as they are and blank or whitespace-only lines are not counted.
+    """
+    with open(path, "rb") as plt_file:
+        for _ in range(PLT_HEADER_LINES):
+            plt_file.readline()
+        return sum(1 for line in plt_file if line.strip())
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as plt_file:
+        while chunk := plt_file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BatchWriter:
+    """
+    Buffers activities and trackpoints in memory and writes them with unordered insert_many calls.
+
+    Activity _ids are generated on the client, so trackpoints can reference their activity before
+    anything has been written. The buffer is flushed when it holds max_documents documents or
+    roughly max_bytes of BSON, and when flush() is called explicitly.
+
+    Manifest entries are written as incomplete before their documents and marked complete afterwards,
+    so an interrupted flush can be detected and cleaned up on the next incremental run.
+
+    With a WritePipeline the batches are handed to its writer threads instead of being written inline,
+    and submitted holds an event per queued batch that is set once it has been written.
+    """
+
+    def __init__(self, activities_collection, trackpoints_collection, manifest_collection=None,
+                 max_documents=50000, max_bytes=16 * 1024 * 1024, verbose=True, pipeline=None):
+        self.activities_collection = activities_collection
+        self.trackpoints_collection = trackpoints_collection
+        self.manifest_collection = manifest_collection
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.pipeline = pipeline
+        self.submitted = []
+        self.activities = []
+        self.trackpoints = []
+        self.manifest_entries = []
+        self.buffered_bytes = 0
+
+    def add_manifest_entry(self, manifest_entry):
+        self.manifest_entries.append(manifest_entry)
+
+    def add(self, activity_record, track_points_list, manifest_entry=None):
+        if manifest_entry is not None:
+            self.add_manifest_entry(manifest_entry)
+        self.activities.append(activity_record)
+        self.trackpoints.extend(track_points_list)
+        # Trackpoints of one activity have the same shape, so one encoded document is a good size estimate
+        self.buffered_bytes += len(bson.encode(activity_record))
+        if track_points_list:
+            self.buffered_bytes += len(bson.encode(track_points_list[0])) * len(track_points_list)
+
+        if len(self.activities) + len(self.trackpoints) >= self.max_documents or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write (or queue) the buffered documents and return the number of activities and trackpoints in the batch."""
+        activities, trackpoints, manifest_entries = self.activities, self.trackpoints, self.manifest_entries
+        self.activities = []
+        self.trackpoints = []
+        self.manifest_entries = []
+        self.buffered_bytes = 0
+
+        if self.pipeline is not None:
+            self.submitted.append(self.pipeline.submit(lambda: self.write(activities, trackpoints, manifest_entries)))
+        else:
+            self.write(activities, trackpoints, manifest_entries)
+        return len(activities), len(trackpoints)
+
+    def write(self, activities, trackpoints, manifest_entries):
+        if self.manifest_collection is not None and manifest_entries:
+            self.manifest_collection.bulk_write(
+                [ReplaceOne({"_id": entry["_id"]}, dict(entry, complete=False), upsert=True) for entry in manifest_entries],
+                ordered=False)
+
+        # Activities go first so a trackpoint never references an activity that is not stored
+        if activities:
+            self.activities_collection.insert_many(activities, ordered=False)
+        if trackpoints:
+            self.trackpoints_collection.insert_many(trackpoints, ordered=False)
+
+        if self.manifest_collection is not None and manifest_entries:
+            self.manifest_collection.update_many({"_id": {"$in": [entry["_id"] for entry in manifest_entries]}},
+                                                 {"$set": {"complete": True}})
+
+        if self.verbose and activities:
+            print(f"Flushed {len(activities)} activities and {len(trackpoints)} trackpoints")
+
+
+class WritePipeline:
+    """
+    Overlaps parsing and writing: batches are put on a bounded queue that writer threads drain.
+
+    When the queue is full, submit() blocks, so a slow server holds back the parser instead of letting
+    batches pile up in memory. The time the parser spent blocked, the time the writers spent waiting
+    for work and the queue depth at every submit are recorded. Errors of every write are kept and
+    raised from the next submit, join or close.
+    """
+
+    def __init__(self, writers=1, max_batches=4):
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.metrics = Counter()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(writers)]
+        for thread in self.threads:
+            thread.start()
+
+    def take_metrics(self):
+        """Return the metrics gathered since the last call and start over."""
+        with self.lock:
+            metrics, self.metrics = self.metrics, Counter()
+        return metrics
+
+    def submit(self, write):
+        """Queue write and return an event that is set once it has run."""
+        self.raise_error()
+        done = threading.Event()
+        depth = self.queue.qsize()
+        start = time.perf_counter()
+        self.queue.put((write, done))
+        with self.lock:
+            self.metrics["queued_batches"] += 1
+            self.metrics["queue_depth_total"] += depth
+            self.metrics["producer_stall_seconds"] += time.perf_counter() - start
+        return done
+
+    def after(self, events, write):
+        """
+        Queue write to run once every event in events is set, without blocking the caller.
+
+        The events have to belong to writes queued before, so a writer thread that picks this up
+        only waits for writes other threads are already running.
+        """
+        def wait_and_write():
+            for event in events:
+                event.wait()
+            write()
+        return self.submit(wait_and_write)
+
+    def run(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            with self.lock:
+                self.metrics["writer_idle_seconds"] += time.perf_counter() - start
+            if item is None:
+                self.queue.task_done()
+                return
+            write, done = item
+            try:
+                write()
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                done.set()
+                self.queue.task_done()
+
+    def raise_error(self):
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise RuntimeError(f"{len(errors)} writes failed, the first with: {errors[0]}") from errors[0]
+
+    def join(self):
+        """Wait until every queued batch is written."""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raise_error()
 
 
 class DataLoader:
 
-    def __init__(self, db_connector, data_dir="./dataset"):
-        self.client = db_connector.client
-        self.db = db_connector.db
-        self.users_collection = self.db["users"]
-        self.activities_collection = self.db["activities"]
-        self.trackpoints_collection = self.db["trackpoints"]
+    def __init__(self, db_connector, data_dir="./dataset", workers=1, batch_documents=50000, batch_bytes=16 * 1024 * 1024,
+                 trackpoint_layout="points", bucket_size=None, packed=False, timeseries=False, pipeline_writers=0, pipeline_depth=4,
+                 simplify_tolerance=None):
+        self.connection = db_connector
+        self._db = None
         self.data_dir = data_dir
         self.MAX_TRACK_POINTS_PER_ACTIVITY = 2500
+        # Query 9 counts activities with a gap longer than this as invalid, simplification keeps those gaps as they are
+        self.MAX_GAP_SECONDS = 5 * 60
+        # Tolerance in meters for simplifying activities longer than MAX_TRACK_POINTS_PER_ACTIVITY, None skips them
+        self.simplify_tolerance = simplify_tolerance
+        self.workers = max(1, workers)
+        self.batch_documents = batch_documents
+        self.batch_bytes = batch_bytes
+        # "points" stores one document per trackpoint, "buckets" one document per activity
+        # (or per bucket_size points) with parallel arrays, optionally packed as binary
+        if trackpoint_layout not in ("points", "buckets"):
+            raise ValueError(f"Unknown trackpoint layout: {trackpoint_layout}")
+        self.trackpoint_layout = trackpoint_layout
+        self.bucket_size = bucket_size
+        self.packed = packed
+        if timeseries and trackpoint_layout != "points":
+            raise ValueError("A time-series trackpoints collection needs the points layout")
+        self.timeseries = timeseries
+        # With pipeline_writers > 0 batches are written by that many threads while the next files are parsed
+        self.pipeline_writers = pipeline_writers
+        self.pipeline_depth = pipeline_depth
+        self.pipeline = None
+        self.verbose = True
+
+    # The client is only used once loading starts, so a lazy connector (as in the worker processes) does not connect before that
+    @property
+    def client(self):
+        return self.connection.client
+
+    @property
+    def db(self):
+        # Loads are written with the connector's bulk write concern, if one is set
+        if self._db is None:
+            self._db = self.connection.bulk_db()
+        return self._db
+
+    @property
+    def users_collection(self):
+        return self.db["users"]
+
+    @property
+    def activities_collection(self):
+        return self.db["activities"]
+
+    @property
+    def trackpoints_collection(self):
+        return self.db["trackpoints"]
+
+    @property
+    def buckets_collection(self):
+        return self.db["trackpoint_buckets"]
+
+    @property
+    def manifest_collection(self):
+        return self.db["manifest"]
 
-    def load_users(self):
+    @property
+    def user_stats_collection(self):
+        return self.db["user_stats"]
+
+    def check_manifest(self):
+        """
+        Refuse an incremental load into a database whose activities were loaded without a manifest.
+
+        Activities do not record the file they came from, so every file would be loaded again and
+        all activities and trackpoints would be duplicated.
+        """
+        if self.manifest_collection.find_one({}, {"_id": 1}) is None and self.activities_collection.find_one({}, {"_id": 1}) is not None:
+            raise RuntimeError("The activities were loaded without a manifest, so an incremental load would duplicate them. "
+                               "Run a full load (without -incremental) first.")
+
+    def load_users(self, incremental=False):
+        if incremental:
+            self.check_manifest()
         user_records = []
 
         with open(self.data_dir + "/labeled_ids.txt", "r") as labeled_ids:
@@ -25,8 +310,15 @@ class DataLoader:
             has_labels = user_id in user_ids_with_labels
             user_records.append({'user_id': user_id, 'has_labels': has_labels})
 
-        self.users_collection.insert_many(user_records)
-        print(f"{len(user_records)} Records inserted successfully into User collection")
+        if incremental:
+            self.users_collection.bulk_write(
+                [UpdateOne({"user_id": record["user_id"]}, {"$set": record}, upsert=True) for record in user_records])
+            self.users_collection.delete_many({"user_id": {"$nin": [record["user_id"] for record in user_records]}})
+            print(f"{len(user_records)} Records upserted successfully into User collection")
+        else:
+            self.users_collection.insert_many(user_records)
+            print(f"{len(user_records)} Records inserted successfully into User collection")
+        bump_dataset_version(self.db)
 
     def get_timestamps(self, df):
         start_date = df.iloc[0, 5]
@@ -37,70 +329,397 @@ class DataLoader:
         end_date_time = end_date + " " + end_time
         return start_date_time, end_date_time
 
-    def load_activities(self):
-        data_dir = self.data_dir + "/Data"
+    def read_labels(self, user_dir):
+        labels = {}
 
-        for user_id in os.listdir(data_dir):
-            user_dir = data_dir + "/" + user_id
-            if not os.path.isdir(user_dir):
-                continue
-            labels = {}
+        if "labels.txt" in os.listdir(user_dir):
+            with open(user_dir + "/labels.txt", "r") as label_file:
+                lines = label_file.readlines()
+                for line in lines[1:]:
+                    start, end, label = line.strip().split("\t")
+                    start, end = start.replace("/", "-"), end.replace("/", "-")
+                    labels[(start, end)] = label
+
+        return labels
+
+    def parse_dates(self, df):
+        """Parse the date and time columns of a whole PLT file in one go."""
+        return pd.to_datetime(df[5] + " " + df[6], format="%Y-%m-%d %H:%M:%S")
+
+    def build_track_points(self, df, date_from, user_id, activity_id):
+        """
+        Build the trackpoint documents for one activity.
+
+        The records are built from the column lists instead of calling DataFrame.apply and strptime
+        for every row. Every trackpoint also gets a GeoJSON location, which is covered by a 2dsphere index.
+        """
+        return [
+            {"user_id": user_id, "activity_id": activity_id, 'lat': lat, 'lon': lon, 'altitude': altitude, 'date_days': date_days, "date_from": date,
+             "location": {"type": "Point", "coordinates": [lon, lat]}}
+            for lat, lon, altitude, date_days, date in zip(
+                df[0].tolist(), df[1].tolist(), df[3].tolist(), df[4].tolist(), date_from.dt.to_pydatetime().tolist())
+        ]
+
+    def summarize_track_points(self, df, date_from):
+        """
+        Compute the trajectory summary that is stored on the activity document.
+
+        Distance and gaps are taken between consecutive points in file order, which lets queries
+        7, 9 and 10 work on the activities collection instead of the trackpoints.
+        """
+        lats = df[0].to_numpy(dtype=float)
+        lons = df[1].to_numpy(dtype=float)
+        distance = haversine_np(lats[:-1], lons[:-1], lats[1:], lons[1:]).sum()
+        gaps = date_from.diff().dt.total_seconds()
+
+        return {
+            "distance_km": float(distance),
+            "duration_seconds": float((date_from.iloc[-1] - date_from.iloc[0]).total_seconds()),
+            "max_gap_seconds": float(gaps.max()) if len(df) > 1 else 0.0,
+            "point_count": len(df),
+            "bounding_box": {"min_lat": float(lats.min()), "min_lon": float(lons.min()),
+                             "max_lat": float(lats.max()), "max_lon": float(lons.max())},
+            "start_location": {"type": "Point", "coordinates": [float(lons[0]), float(lats[0])]},
+            "end_location": {"type": "Point", "coordinates": [float(lons[-1]), float(lats[-1])]},
+        }
 
-            if "labels.txt" in os.listdir(user_dir):
-                with open(user_dir + "/labels.txt", "r") as label_file:
-                    lines = label_file.readlines()
-                    for line in lines[1:]:
-                        start, end, label = line.strip().split("\t")
-                        start, end = start.replace("/", "-"), end.replace("/", "-")
-                        labels[(start, end)] = label
+    def delete_files(self, manifest_entries):
+        """Delete the activities, trackpoints and manifest entries that were loaded from the given files."""
+        activity_ids = [entry["activity_id"] for entry in manifest_entries if entry.get("activity_id") is not None]
+        if activity_ids:
+            self.trackpoints_collection.delete_many({"activity_id": {"$in": activity_ids}})
+            self.buckets_collection.delete_many({"activity_id": {"$in": activity_ids}})
+            self.activities_collection.delete_many({"_id": {"$in": activity_ids}})
+        self.manifest_collection.delete_many({"_id": {"$in": [entry["_id"] for entry in manifest_entries]}})
 
-            for activity in os.listdir(user_dir + "/Trajectory"):
-                track_points = pd.read_csv(user_dir + "/Trajectory/" + activity, skiprows=6, header=None)
+    def load_user_activities(self, user_id, incremental=False):
+        """
+        Load all activities and trackpoints for a single user.
 
-                if len(track_points) > self.MAX_TRACK_POINTS_PER_ACTIVITY:
+        Every PLT file gets an entry in the manifest collection. In incremental mode files whose size,
+        mtime or content hash match a complete manifest entry are skipped, changed files and files from
+        an interrupted run are reloaded, and documents of removed files are deleted. Oversized files are
+        marked as skipped in the manifest and loaded by the first incremental run with simplify_tolerance set.
+
+        Returns a Counter with the number of activities and trackpoints that were inserted for the user,
+        and the number of files (and their bytes) that were skipped without being parsed.
+        With simplify_tolerance set, files with more than MAX_TRACK_POINTS_PER_ACTIVITY points are loaded
+        instead, with their points simplified (see simplify.simplify_track) and the original count kept in point_count.
+        The simplified points keep every gap longer than MAX_GAP_SECONDS and add none, so query 9 gives the same
+        answer from the stored trackpoints as from max_gap_seconds.
+        """
+        user_dir = self.data_dir + "/Data/" + user_id
+        labels = self.read_labels(user_dir)
+        trackpoints_collection = self.buckets_collection if self.trackpoint_layout == "buckets" else self.trackpoints_collection
+        if self.pipeline_writers and self.pipeline is None:
+            self.pipeline = WritePipeline(self.pipeline_writers, self.pipeline_depth)
+        writer = BatchWriter(self.activities_collection, trackpoints_collection, self.manifest_collection,
+                             max_documents=self.batch_documents, max_bytes=self.batch_bytes, verbose=self.verbose,
+                             pipeline=self.pipeline)
+        counts = Counter()
+        manifest = {}
+        if incremental:
+            manifest = {entry["_id"]: entry for entry in self.manifest_collection.find({"user_id": user_id})}
+
+        for activity in sorted(os.listdir(user_dir + "/Trajectory")):
+            path = user_dir + "/Trajectory/" + activity
+            key = user_id + "/Trajectory/" + activity
+            stat = os.stat(path)
+            entry = manifest.pop(key, None)
+            # A file that an earlier run skipped as oversized is loaded once it can be simplified
+            retry_skipped = entry is not None and entry.get("skipped") and self.simplify_tolerance is not None
+
+            if entry is not None and entry.get("complete") and not retry_skipped:
+                if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                    counts["unchanged_files"] += 1
                     continue
+                content_hash = hash_file(path)
+                if entry["hash"] == content_hash:
+                    self.manifest_collection.update_one({"_id": key}, {"$set": {"mtime": stat.st_mtime}})
+                    counts["unchanged_files"] += 1
+                    continue
+                counts["changed_files"] += 1
+            else:
+                content_hash = hash_file(path)
+                if retry_skipped:
+                    counts["simplified_skipped_files"] += 1
+                elif entry is not None:
+                    counts["resumed_files"] += 1
+
+            # Documents from an older version of the file, or from an interrupted run, are replaced
+            if entry is not None:
+                self.delete_files([entry])
+
+            manifest_entry = {"_id": key, "user_id": user_id, "size": stat.st_size, "mtime": stat.st_mtime,
+                              "hash": content_hash, "activity_id": None}
+
+            oversized = count_track_points(path) > self.MAX_TRACK_POINTS_PER_ACTIVITY
+            if oversized and self.simplify_tolerance is None:
+                writer.add_manifest_entry(dict(manifest_entry, skipped=True))
+                counts["skipped_files"] += 1
+                counts["skipped_bytes"] += stat.st_size
+                continue
+
+            track_points = pd.read_csv(path, skiprows=PLT_HEADER_LINES, header=None)
+
+            start_date_time, end_date_time = self.get_timestamps(track_points)
+            transportation_mode = labels.get((start_date_time, end_date_time), None)
+
+            filtered_track_points = track_points[track_points.iloc[:, 3] != -777]
+            altitude_diff = filtered_track_points.iloc[:, 3].diff()
+            altitude_gained = altitude_diff[altitude_diff > 0].sum()
 
-                start_date_time, end_date_time = self.get_timestamps(track_points)
-                transportation_mode = labels.get((start_date_time, end_date_time), None)
+            activity_record = {
+                "user_id": user_id,
+                'transportation_mode': transportation_mode,
+                'start_date_time': datetime.strptime(start_date_time, "%Y-%m-%d %H:%M:%S"),
+                'end_date_time': datetime.strptime(end_date_time, "%Y-%m-%d %H:%M:%S"),
+                "altitude_gained": altitude_gained,
+            }
+            date_from = self.parse_dates(track_points)
+            activity_record.update(self.summarize_track_points(track_points, date_from))
 
-                filtered_track_points = track_points[track_points.iloc[:, 3] != -777]
-                altitude_diff = filtered_track_points.iloc[:, 3].diff()
-                altitude_gained = altitude_diff[altitude_diff > 0].sum()
+            # The summary and altitude gain above come from every point, only the stored points are simplified
+            if oversized:
+                seconds = (date_from - date_from.iloc[0]).dt.total_seconds().to_numpy()
+                keep = simplify_track(track_points[0].to_numpy(dtype=float), track_points[1].to_numpy(dtype=float),
+                                      self.simplify_tolerance, self.MAX_TRACK_POINTS_PER_ACTIVITY,
+                                      times=seconds, max_gap=self.MAX_GAP_SECONDS)
+                track_points, date_from = track_points.iloc[keep], date_from.iloc[keep]
+                activity_record["stored_point_count"] = len(keep)
+                counts["simplified_files"] += 1
 
-                track_points_list = track_points.apply(
-                    lambda row: {"user_id": user_id, "activity_id": activity, 'lat': row[0], 'lon': row[1], 'altitude': row[3], 'date_days': row[4],
-                                 "date_from": datetime.strptime(row[5] + " " + row[6], "%Y-%m-%d %H:%M:%S")}, axis=1).tolist()
+            activity_record["_id"] = ObjectId()
+            if self.trackpoint_layout == "buckets":
+                track_points_list = build_buckets(track_points, date_from, user_id, activity_record["_id"], self.bucket_size, self.packed)
+            else:
+                track_points_list = self.build_track_points(track_points, date_from, user_id, activity_record["_id"])
 
-                activity_record = {
-                    "user_id": user_id,
-                    'transportation_mode': transportation_mode,
-                    'start_date_time': datetime.strptime(start_date_time, "%Y-%m-%d %H:%M:%S"),
-                    'end_date_time': datetime.strptime(end_date_time, "%Y-%m-%d %H:%M:%S"),
-                    "altitude_gained": altitude_gained,
-                }
+            manifest_entry["activity_id"] = activity_record["_id"]
+            writer.add(activity_record, track_points_list, manifest_entry)
+            counts["activities"] += 1
+            counts["trackpoints"] += len(track_points)
 
-                activity_id = self.activities_collection.insert_one(activity_record).inserted_id
+        writer.flush()
 
-                for tp in track_points_list:
-                    tp["activity_id"] = activity_id
+        # Whatever is left in the manifest belongs to files that no longer exist
+        if manifest:
+            self.delete_files(list(manifest.values()))
+            counts["removed_files"] += len(manifest)
 
-                self.trackpoints_collection.insert_many(track_points_list)
-                print(f"{len(track_points_list)} trackpoints inserted successfully for activity {activity}")
+        if not incremental or any(counts[key] for key in ("activities", "changed_files", "resumed_files", "removed_files",
+                                                          "simplified_skipped_files")):
+            if self.pipeline is not None:
+                # The statistics are computed from the written activities, so they wait for this user's batches.
+                # The parser goes on with the next user meanwhile
+                self.pipeline.after(writer.submitted, lambda: self.update_user_stats(user_id))
+            else:
+                self.update_user_stats(user_id)
+        return counts
 
-            print(f"Activities and trackpoints inserted successfully for user {user_id}")
+    def update_user_stats(self, user_id):
+        """
+        Recompute the user_stats document of a user from their activities.
 
-        print("All records inserted successfully.")
+        The document holds the activity count, the number of activities per transportation mode,
+        the number of activities and recorded hours per start year and the total altitude gained,
+        so queries 2, 3, 5, 6, 8 and 11 do not have to aggregate over all activities.
+        """
+        activities = self.activities_collection.find(
+            {"user_id": user_id},
+            {"_id": 0, "transportation_mode": 1, "start_date_time": 1, "end_date_time": 1, "altitude_gained": 1})
+
+        transportation_modes = Counter()
+        activities_per_year = Counter()
+        hours_per_year = Counter()
+        altitude_gained = 0.0
+        activity_count = 0
+        for activity in activities:
+            activity_count += 1
+            if activity["transportation_mode"] is not None:
+                transportation_modes[activity["transportation_mode"]] += 1
+            year = str(activity["start_date_time"].year)
+            activities_per_year[year] += 1
+            hours_per_year[year] += (activity["end_date_time"] - activity["start_date_time"]).total_seconds() / 3600
+            altitude_gained += float(activity["altitude_gained"])
+
+        self.user_stats_collection.replace_one({"_id": user_id}, {
+            "activity_count": activity_count,
+            "transportation_modes": dict(transportation_modes),
+            "activities_per_year": dict(activities_per_year),
+            "hours_per_year": dict(hours_per_year),
+            "altitude_gained": altitude_gained,
+        }, upsert=True)
+
+    def worker_options(self):
+        """The constructor arguments a worker process needs to load users the same way as this loader."""
+        return {
+            "data_dir": self.data_dir,
+            "batch_documents": self.batch_documents,
+            "batch_bytes": self.batch_bytes,
+            "trackpoint_layout": self.trackpoint_layout,
+            "bucket_size": self.bucket_size,
+            "packed": self.packed,
+            "pipeline_writers": self.pipeline_writers,
+            "pipeline_depth": self.pipeline_depth,
+            "simplify_tolerance": self.simplify_tolerance,
+        }
+
+    def get_user_ids(self):
+        data_dir = self.data_dir + "/Data"
+        return [user_id for user_id in sorted(os.listdir(data_dir)) if os.path.isdir(data_dir + "/" + user_id)]
+
+    def load_activities(self, incremental=False):
+        """
+        Load activities and trackpoints for every user in the dataset.
+
+        With workers > 1 the user directories are spread across a process pool where every
+        worker process opens its own MongoClient. The per-user counts are combined at the end.
+        With incremental=True only new or changed files are loaded, see load_user_activities.
+        """
+        if incremental:
+            self.check_manifest()
+        user_ids = self.get_user_ids()
+        totals = Counter()
+        self.create_trackpoints_collection()
+
+        if incremental:
+            removed_users = set(self.manifest_collection.distinct("user_id")) - set(user_ids)
+            for user_id in removed_users:
+                entries = list(self.manifest_collection.find({"user_id": user_id}))
+                self.delete_files(entries)
+                self.user_stats_collection.delete_one({"_id": user_id})
+                totals["removed_files"] += len(entries)
+
+        try:
+            if self.workers == 1:
+                for user_id in user_ids:
+                    totals += self.load_user_activities(user_id, incremental)
+                    print(f"Activities and trackpoints inserted successfully for user {user_id}")
+                if self.pipeline is not None:
+                    self.pipeline.join()
+                    totals.update(self.pipeline.take_metrics())
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers,
+                                         initializer=_init_worker,
+                                         initargs=(self.connection.settings, self.MAX_TRACK_POINTS_PER_ACTIVITY,
+                                                   self.worker_options())) as executor:
+                    futures = {executor.submit(_load_user_worker, user_id, incremental): user_id for user_id in user_ids}
+                    for future in as_completed(futures):
+                        counts = future.result()
+                        totals += counts
+                        print(f"{counts['activities']} activities and {counts['trackpoints']} trackpoints inserted successfully for user {futures[future]}")
+        finally:
+            # Stop the writer threads even when loading failed, so they are not left behind
+            if self.pipeline is not None:
+                pipeline, self.pipeline = self.pipeline, None
+                pipeline.close()
+
+        print(f"All records inserted successfully. ({totals['activities']} activities, {totals['trackpoints']} trackpoints)")
+        if self.simplify_tolerance is None:
+            print(f"Skipped {totals['skipped_files']} oversized files without parsing them ({totals['skipped_bytes'] / 1024 / 1024:.1f} MB)")
+        else:
+            print(f"Simplified {totals['simplified_files']} oversized activities to at most {self.MAX_TRACK_POINTS_PER_ACTIVITY} points")
+        if incremental:
+            print(f"{totals['unchanged_files']} files unchanged, {totals['changed_files']} changed, "
+                  f"{totals['resumed_files']} resumed, {totals['simplified_skipped_files']} skipped before and simplified now "
+                  f"and {totals['removed_files']} removed")
+        if self.pipeline_writers:
+            print(f"Write pipeline: {totals['queued_batches']} batches, parser stalled {totals['producer_stall_seconds']:.2f} s, "
+                  f"writers idle {totals['writer_idle_seconds']:.2f} s, "
+                  f"average queue depth {totals['queue_depth_total'] / max(1, totals['queued_batches']):.2f}")
+        bump_dataset_version(self.db)
+        return totals
+
+    def create_trackpoints_collection(self):
+        """
+        Create trackpoints as a time-series collection if that option is set and it does not exist yet.
+
+        activity_id is the metaField so the documents keep the same fields as in a plain collection
+        and Queries works unchanged. user_id is constant within an activity, so it compresses to almost nothing.
+        """
+        if not self.timeseries or "trackpoints" in self.db.list_collection_names():
+            return
+        self.db.create_collection("trackpoints", timeseries={
+            "timeField": "date_from",
+            "metaField": "activity_id",
+            "granularity": "seconds",
+        })
+        print("Created trackpoints as a time-series collection")
+
+    def print_collection_stats(self):
+        """Print the document count, data size, storage size and index size of every collection."""
+        table = []
+        for name in ["users", "activities", "trackpoints", "trackpoint_buckets"]:
+            if name not in self.db.list_collection_names():
+                continue
+            stats = self.db.command("collStats", name)
+            table.append((name, stats.get("count"), stats.get("size", 0) / 1024 / 1024,
+                          stats.get("storageSize", 0) / 1024 / 1024, stats.get("totalIndexSize", 0) / 1024 / 1024))
+        print(tabulate(table, headers=["Collection", "Documents", "Data size (MB)", "Storage size (MB)", "Index size (MB)"],
+                       floatfmt=".2f"))
+
+    def create_indexes(self):
+        """Build the query indexes. Called after the bulk load so the inserts do not maintain them."""
+        IndexManager(self.connection).create_indexes()
 
     def drop_collections(self):
         self.users_collection.drop()
         self.activities_collection.drop()
         self.trackpoints_collection.drop()
+        self.buckets_collection.drop()
+        self.manifest_collection.drop()
+        self.user_stats_collection.drop()
+        bump_dataset_version(self.db)
         print("All collections have been dropped.")
 
 
+# Loader owned by each worker process in parallel mode
+_worker_loader = None
+
+
+def _init_worker(settings, max_track_points, options):
+    """Give every worker process its own MongoClient and DataLoader."""
+    global _worker_loader
+    connector = DbConnector(**settings, lazy=True, quiet=True)
+    _worker_loader = DataLoader(connector, **options)
+    _worker_loader.MAX_TRACK_POINTS_PER_ACTIVITY = max_track_points
+    _worker_loader.verbose = False
+
+
+def _load_user_worker(user_id, incremental):
+    counts = _worker_loader.load_user_activities(user_id, incremental)
+    # Report the writes of this user, and their errors, with its counts
+    if _worker_loader.pipeline is not None:
+        _worker_loader.pipeline.join()
+        counts.update(_worker_loader.pipeline.take_metrics())
+    return counts
+
+
 if __name__ == "__main__":
-    db_connector = DbConnector(DATABASE="my_db", HOST="tdt4225-21.idi.ntnu.no", USER="mongo", PASSWORD="mongo")
-    loader = DataLoader(db_connector)
-    loader.drop_collections()
-    loader.load_users()
-    loader.load_activities()
+    parser = argparse.ArgumentParser(description="Load the Geolife dataset into MongoDB")
+    parser.add_argument("-workers", type=int, default=1, help="Number of worker processes used for loading activities")
+    parser.add_argument("-incremental", action="store_true", help="Only load new or changed files instead of reloading everything")
+    parser.add_argument("-layout", choices=["points", "buckets"], default="points", help="How trackpoints are stored")
+    parser.add_argument("-bucket-size", type=int, default=None, help="Maximum number of points per bucket (default: one bucket per activity)")
+    parser.add_argument("-packed", action="store_true", help="Store bucket arrays as packed binary")
+    parser.add_argument("-timeseries", action="store_true", help="Create trackpoints as a time-series collection")
+    parser.add_argument("-pipeline-writers", type=int, default=0, help="Number of writer threads that write while files are parsed")
+    parser.add_argument("-pipeline-depth", type=int, default=4, help="Maximum number of batches waiting to be written")
+    parser.add_argument("-simplify", type=float, default=None,
+                        help="Store oversized activities simplified with this tolerance in meters instead of skipping them")
+    args = parser.parse_args()
+
+    with DbConnector() as db_connector:
+        loader = DataLoader(db_connector, workers=args.workers, trackpoint_layout=args.layout, bucket_size=args.bucket_size, packed=args.packed,
+                            timeseries=args.timeseries, pipeline_writers=args.pipeline_writers, pipeline_depth=args.pipeline_depth,
+                            simplify_tolerance=args.simplify)
+        try:
+            if not args.incremental:
+                loader.drop_collections()
+            loader.load_users(incremental=args.incremental)
+            loader.load_activities(incremental=args.incremental)
+            loader.create_indexes()
+            loader.print_collection_stats()
+        except RuntimeError as e:
+            print("ERROR: Failed to load the dataset:", e)
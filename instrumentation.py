@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import bson
+from pymongo import monitoring
+from tabulate import tabulate
+
+# Commands whose query plan can be captured with explain
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct"}
+
+# Fields the driver adds to a command that the explain command does not accept
+DRIVER_FIELDS = {"lsid", "txnNumber", "$db", "$clusterTime", "$readPreference", "readConcern", "writeConcern"}
+
+
+def command_collection(event):
+    """Name of the collection a command runs against, if any."""
+    if event.command_name == "getMore":
+        return event.command.get("collection")
+    value = event.command.get(event.command_name)
+    return value if isinstance(value, str) else None
+
+
+def returned_documents(reply):
+    """Number of documents in a command reply."""
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "values" in reply:
+        return len(reply["values"])
+    return reply.get("n", 0)
+
+
+def plan_stages(plan):
+    """Return the names of all stages in an explain() plan, from the root down."""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for input_stage in plan.get("inputStages", []):
+        stages += plan_stages(input_stage)
+    return stages
+
+
+def command_filter(command):
+    """The filter a recorded find, count, distinct or aggregate command selects its documents with."""
+    if "filter" in command:
+        return command["filter"]
+    if "query" in command:
+        return command["query"]
+    pipeline = command.get("pipeline", [])
+    if pipeline and "$match" in pipeline[0]:
+        return pipeline[0]["$match"]
+    return {}
+
+
+def explain_command(db, command):
+    """Explain a recorded command and return the stages of every winning plan in it."""
+    command = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+    explain = db.command("explain", command, verbosity="queryPlanner")
+    return [plan_stages(plan) for plan in winning_plans(explain)]
+
+
+def winning_plans(explain):
+    """Find every winningPlan in an explain() output, also the ones nested in aggregation stages."""
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                yield value
+            else:
+                yield from winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from winning_plans(value)
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    Records every command a MongoClient sends, using pymongo's command monitoring.
+
+    For each command the name, collection, latency, documents and bytes returned are recorded,
+    attributed to the label set with track(), for example the name of the query that is running.
+    With explain=True the find/aggregate/count/distinct commands of every tracked block are explained
+    afterwards and stages doing a COLLSCAN are flagged.
+    """
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        # Queries can run on several threads at once, each with its own label
+        self.local = threading.local()
+        self.pending = {}
+        self.commands = []
+        self.wall_times = {}
+        self.explains = defaultdict(list)
+
+    @property
+    def label(self):
+        return getattr(self.local, "label", None)
+
+    @label.setter
+    def label(self, label):
+        self.local.label = label
+
+    def started(self, event):
+        if getattr(self.local, "paused", False):
+            return
+        self.pending[event.request_id] = (self.label, event)
+
+    def succeeded(self, event):
+        self.finish(event, event.reply, failed=False)
+
+    def failed(self, event):
+        self.finish(event, {}, failed=True)
+
+    def finish(self, event, reply, failed):
+        if event.request_id not in self.pending:
+            return
+        label, started_event = self.pending.pop(event.request_id)
+        self.commands.append({
+            "label": label,
+            "command": event.command_name,
+            "collection": command_collection(started_event),
+            "latency_ms": event.duration_micros / 1000,
+            "documents": returned_documents(reply),
+            "bytes": len(bson.encode(reply)) if reply else 0,
+            "failed": failed,
+            # Only kept when needed, insert commands hold every inserted document
+            "spec": started_event.command if self.explain and event.command_name in EXPLAINABLE_COMMANDS else None,
+        })
+
+    @contextmanager
+    def paused(self):
+        """Do not record the commands this thread sends inside the block."""
+        self.local.paused = True
+        try:
+            yield
+        finally:
+            self.local.paused = False
+
+    @contextmanager
+    def track(self, label):
+        """Attribute all commands sent inside the block to label and record its wall time."""
+        previous_label, self.label = self.label, label
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.label = previous_label
+            self.wall_times[label] = (time.perf_counter() - start) * 1000
+
+    def explain_commands(self, db, label):
+        """Explain the commands recorded for label and store the stages of every winning plan."""
+        with self.paused():
+            for record in self.commands:
+                if record["label"] != label or record["spec"] is None:
+                    continue
+                for stages in explain_command(db, record["spec"]):
+                    self.explains[label].append((record["command"], record["collection"], stages))
+
+    def summary(self):
+        """Rows of (label, commands, getMores, total latency, documents, bytes, wall time, collection scans)."""
+        rows = {}
+        for record in self.commands:
+            row = rows.setdefault(record["label"], {"commands": 0, "get_mores": 0, "latency_ms": 0.0, "documents": 0, "bytes": 0})
+            row["commands"] += 1
+            row["get_mores"] += record["command"] == "getMore"
+            row["latency_ms"] += record["latency_ms"]
+            row["documents"] += record["documents"]
+            row["bytes"] += record["bytes"]
+
+        return [(label, row["commands"], row["get_mores"], row["latency_ms"], row["documents"], row["bytes"], self.wall_times.get(label),
+                 sum("COLLSCAN" in stages for _, _, stages in self.explains.get(label, [])))
+                for label, row in rows.items()]
+
+    def print_summary(self):
+        print(tabulate(self.summary(), headers=["Query", "Commands", "getMores", "DB time (ms)", "Documents",
+                                                "Bytes", "Wall time (ms)", "COLLSCANs"], floatfmt=".2f"))
+        for label, plans in self.explains.items():
+            for command, collection, stages in plans:
+                if "COLLSCAN" in stages:
+                    print(f"COLLSCAN in {label}: {command} on {collection} ({' <- '.join(stages)})")
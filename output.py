@@ -0,0 +1,80 @@
+import io
+import sys
+import threading
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+
+class ThreadLocalStdout:
+    """
+    Stand-in for sys.stdout that sends a thread's output to that thread's buffer, if it has one.
+
+    contextlib.redirect_stdout swaps sys.stdout for the whole process, so it cannot separate the
+    output of queries running at the same time on different threads.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, "buffer", None) or self.stdout
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        return self.current().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+_install_lock = threading.Lock()
+
+
+@contextmanager
+def capture_output():
+    """Collect everything the current thread prints inside the block in a StringIO, which is yielded."""
+    with _install_lock:
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+    proxy = sys.stdout
+    previous = getattr(proxy.local, "buffer", None)
+    buffer = io.StringIO()
+    proxy.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        proxy.local.buffer = previous
+
+
+def print_table(rows, headers, chunk_rows=1000):
+    """
+    Print rows with tabulate as they are read from an iterator, chunk_rows at a time.
+
+    A result of at most chunk_rows rows prints exactly like tabulate(list(rows), headers=headers).
+    Later chunks are laid out together with the first one, so their columns line up with the header
+    unless they hold a wider value. Only the first chunk and the current one are kept in memory.
+    """
+    first_chunk = None
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            first_chunk = print_chunk(first_chunk, chunk, headers)
+            chunk = []
+    if chunk or first_chunk is None:
+        print_chunk(first_chunk, chunk, headers)
+
+
+def print_chunk(first_chunk, chunk, headers):
+    """Print one chunk of print_table and return the first chunk."""
+    if first_chunk is None:
+        print(tabulate(chunk, headers=headers))
+        return chunk
+    lines = tabulate(first_chunk + chunk, headers=headers).split("\n")
+    # Skip the header, its underline and the rows of the first chunk
+    print("\n".join(lines[2 + len(first_chunk):]))
+    return first_chunk
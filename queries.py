@@ -1,63 +1,232 @@
 import argparse
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from itertools import groupby
 from pprint import pprint
 
-import pandas as pd
-from haversine import haversine
+import numpy as np
 from tabulate import tabulate
 
+from buckets import decode_bucket, points_in_polygon
 from DbConnector import DbConnector
+from output import capture_output
+from query_cache import CachedQueries
+from query_rows import (AltitudeGain, AverageActivities, BusiestYears, CollectionCount, Distance, InvalidActivities,
+                        ModeActivities, MostUsedMode, QueryPrinter, RegionUser, TaxiUser, UserActivities)
 
+# Mean earth radius in km, the same value the haversine package uses
+EARTH_RADIUS = 6371.0088
 
-class Queries:
 
-    def __init__(self, db_connector):
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Vectorized haversine distance in km between arrays of coordinates given in degrees."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def region_filter(min_lat, min_lon, max_lat, max_lon, polygon=None, geo_within=True):
+    """
+    Build a trackpoint filter for a region given as a bounding box or a polygon of (lon, lat) pairs.
+
+    The $geoWithin variant is answered from the 2dsphere index on location. The range variant only
+    supports bounding boxes and works on data that was loaded without the location field.
+    $geoWithin includes points on the edges of the region, the range variant leaves out the upper edges.
+    """
+    if not geo_within:
+        return {"lat": {"$gte": min_lat, "$lt": max_lat}, "lon": {"$gte": min_lon, "$lt": max_lon}}
+
+    if polygon is None:
+        polygon = [(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)]
+    ring = [list(point) for point in polygon]
+    # GeoJSON rings have to be closed
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return {"location": {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [ring]}}}}
+
+
+class Queries(QueryPrinter):
+    """
+    Answers the assignment queries from MongoDB.
+
+    The iter_query_* methods return lazy iterators of typed rows for use from other code, the query_*
+    methods (see QueryPrinter) print them. Cursors fetch batch_size documents per round trip and
+    aggregations may spill to disk on the server when allow_disk_use is set.
+    """
+
+    def __init__(self, db_connector, use_summaries=None, trackpoint_layout="points", use_user_stats=None,
+                 batch_size=10000, allow_disk_use=True):
         self.connection = db_connector
-        self.client = db_connector.client
-        self.db = db_connector.db
-        self.users_collection = self.db["users"]
-        self.activities_collection = self.db["activities"]
-        self.trackpoints_collection = self.db["trackpoints"]
+        # Answer queries 7, 9 and 10 from the trajectory summaries stored on the activities.
+        # None uses them only if every activity has one, see summaries_enabled
+        self.use_summaries = use_summaries
+        # Answer queries 2, 3, 5, 6, 8 and 11 from the user_stats collection maintained by DataLoader.
+        # None uses it only if it covers every activity, see user_stats_enabled
+        self.use_user_stats = use_user_stats
+        # Whether trackpoints have a GeoJSON location for query 10, checked on first use, see locations_enabled
+        self.use_locations = None
+        # Read trackpoints from one document per point ("points") or from trackpoint_buckets ("buckets")
+        self.trackpoint_layout = trackpoint_layout
+        self.batch_size = batch_size
+        self.allow_disk_use = allow_disk_use
+
+    # The client is only used once a query runs, so a lazy connector does not connect before that
+    @property
+    def client(self):
+        return self.connection.client
+
+    @property
+    def db(self):
+        return self.connection.db
+
+    @property
+    def users_collection(self):
+        return self.db["users"]
+
+    @property
+    def activities_collection(self):
+        return self.db["activities"]
+
+    @property
+    def trackpoints_collection(self):
+        return self.db["trackpoints"]
+
+    @property
+    def buckets_collection(self):
+        return self.db["trackpoint_buckets"]
+
+    @property
+    def user_stats_collection(self):
+        return self.db["user_stats"]
+
+    def summaries_enabled(self):
+        """
+        Whether queries 7, 9 and 10 are answered from the activity summaries.
 
-    def query_one(self):
-        """How many users, activities and trackpoints are there in the dataset"""
-        user_count = self.users_collection.count_documents({})
-        activity_count = self.activities_collection.count_documents({})
-        trackpoint_count = self.trackpoints_collection.count_documents({})
+        With use_summaries=None this is checked on first use: activities loaded before the summaries were
+        added to DataLoader do not have them, and the trackpoints have to be read instead.
+        """
+        if self.use_summaries is None:
+            summarized = self.activities_collection.count_documents({"max_gap_seconds": {"$exists": True}})
+            self.use_summaries = summarized == self.activities_collection.count_documents({})
+        return self.use_summaries
+
+    def user_stats_enabled(self):
+        """
+        Whether queries 2, 3, 5, 6, 8 and 11 are answered from the user_stats collection.
+
+        With use_user_stats=None this is checked on first use: the activity counts in user_stats have to add
+        up to the number of activities. Otherwise (a database loaded before user_stats was added to DataLoader)
+        the activities are aggregated instead.
+        """
+        if self.use_user_stats is None:
+            result = list(self.user_stats_collection.aggregate([{"$group": {"_id": None, "activities": {"$sum": "$activity_count"}}}]))
+            counted = result[0]["activities"] if result else 0
+            activity_count = self.activities_collection.count_documents({})
+            self.use_user_stats = activity_count > 0 and counted == activity_count
+        return self.use_user_stats
+
+    def locations_enabled(self):
+        """
+        Whether the trackpoints have the GeoJSON location field that query 10 matches with $geoWithin.
+
+        Trackpoints loaded before the field was added to DataLoader only have lat and lon. The oldest
+        trackpoint is checked, since every later load adds the field.
+        """
+        if self.use_locations is None:
+            oldest = self.trackpoints_collection.find_one({}, {"location": 1}, sort=[("_id", 1)])
+            self.use_locations = oldest is not None and "location" in oldest
+        return self.use_locations
+
+    def aggregate(self, collection, pipeline):
+        return collection.aggregate(pipeline, allowDiskUse=self.allow_disk_use, batchSize=self.batch_size)
 
-        table_data = [
-        ["Users", user_count],
-        ["Activities", activity_count],
-        ["Trackpoints", trackpoint_count]]
+    def find(self, collection, filter, projection=None):
+        return collection.find(filter, projection).batch_size(self.batch_size)
 
-        print(tabulate(table_data, headers=["Collection", "Count"]))
-        
+    def iter_user_stats(self, fields):
+        """Stream the user_stats documents of users with at least one activity, with the given fields."""
+        return self.find(self.user_stats_collection, {"activity_count": {"$gt": 0}}, {field: 1 for field in fields})
 
-    def query_two(self):
+    def iter_activity_points(self, query, fields, batch_size=None):
+        """
+        Yield (activity_id, user_id, arrays) for every activity matching query, one activity at a time.
+
+        arrays holds a NumPy array per requested field in time order, with date_from as datetime64[ms].
+        Only the points of the current activity are kept in memory. The sort may spill to disk on the
+        server when allow_disk_use is set, it covers the whole collection when query is empty.
+        """
+        batch_size = batch_size or self.batch_size
+        if self.trackpoint_layout == "buckets":
+            buckets = self.buckets_collection.find(
+                query,
+                {"_id": 0, "activity_id": 1, "user_id": 1, "packed": 1, **{field: 1 for field in fields}}
+            ).sort([("activity_id", 1), ("chunk", 1)]).allow_disk_use(self.allow_disk_use).batch_size(batch_size)
+
+            for activity_id, group in groupby(buckets, key=lambda bucket: bucket["activity_id"]):
+                group = list(group)
+                chunks = [decode_bucket(bucket) for bucket in group]
+                yield activity_id, group[0]["user_id"], {field: np.concatenate([chunk[field] for chunk in chunks]) for field in fields}
+            return
+
+        trackpoints = self.trackpoints_collection.find(
+            query,
+            {"_id": 0, "activity_id": 1, "user_id": 1, **{field: 1 for field in fields}}
+        ).sort([("activity_id", 1), ("date_from", 1)]).allow_disk_use(self.allow_disk_use).batch_size(batch_size)
+
+        for activity_id, group in groupby(trackpoints, key=lambda trackpoint: trackpoint["activity_id"]):
+            group = list(group)
+            arrays = {field: np.array([trackpoint[field] for trackpoint in group],
+                                      dtype="datetime64[ms]" if field == "date_from" else float) for field in fields}
+            yield activity_id, group[0]["user_id"], arrays
+
+    def iter_query_one(self):
+        """How many users, activities and trackpoints are there in the dataset"""
+        yield CollectionCount("Users", self.users_collection.count_documents({}))
+        yield CollectionCount("Activities", self.activities_collection.count_documents({}))
+        if self.trackpoint_layout == "buckets":
+            result = list(self.aggregate(self.buckets_collection, [{"$group": {"_id": None, "count": {"$sum": "$count"}}}]))
+            trackpoint_count = result[0]["count"] if result else 0
+        else:
+            trackpoint_count = self.trackpoints_collection.count_documents({})
+        yield CollectionCount("Trackpoints", trackpoint_count)
+
+    def iter_query_two(self):
         """Find the average number of activities per user.
 
         Calculates the number of activities for each user and then calculates the average.
         """
-        result = self.activities_collection.aggregate([
+        if self.user_stats_enabled():
+            counts = [stats["activity_count"] for stats in self.iter_user_stats(["activity_count"])]
+            yield AverageActivities(sum(counts) / len(counts))
+            return
+
+        result = self.aggregate(self.activities_collection, [
             {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
             {"$group": {"_id": "null", "avg": {"$avg": "$count"}}}
         ])
-        average_activities_per_user = list(result)[0]['avg']
-        print(f"Average number of activities per user: {average_activities_per_user :.2f}")
+        yield AverageActivities(list(result)[0]['avg'])
 
     """Find the top 20 users with the highest number of activities."""
-    def query_three(self):
+    def iter_query_three(self):
         group_users = {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
         sort_by_count = {"$sort": {"count": -1}}
         limit = {"$limit": 20}
 
-        top_users = self.activities_collection.aggregate([group_users, sort_by_count, limit])
+        if self.user_stats_enabled():
+            top_users = self.iter_user_stats(["activity_count"]).sort("activity_count", -1).limit(20)
+            for user in top_users:
+                yield UserActivities(user["_id"], user["activity_count"])
+            return
 
-        table = [(user["_id"], user["count"]) for user in top_users]
-        print(tabulate(table, headers=["User", "Number of activities"]))
-        
+        top_users = self.aggregate(self.activities_collection, [group_users, sort_by_count, limit])
+        for user in top_users:
+            yield UserActivities(user["_id"], user["count"])
 
-    def query_four(self):
+    def iter_query_four(self):
         """Find all users who have taken a taxi."""
         result = self.activities_collection.distinct(
             "user_id",
@@ -66,18 +235,27 @@ class Queries:
             }
         )
 
-        print(tabulate([[line] for line in list(result)], headers=["All users who have taken a taxi"]))
+        for user in result:
+            yield TaxiUser(user)
 
-    def query_five(self):
+    def iter_query_five(self):
         transportation_not_null = { "$match": {"transportation_mode": {"$ne": None}}}
         group_transportation = {"$group": { "_id": "$transportation_mode", "activity_count": {"$sum": 1}}}
         sort_by_count = {"$sort": {"activity_count": -1}}
 
-        transportation_modes_in_activites = self.activities_collection.aggregate([transportation_not_null, group_transportation, sort_by_count])
-        table = [(transport["_id"], transport["activity_count"]) for transport in transportation_modes_in_activites]
-        print(tabulate(table, headers=["Transportation mode", "Number of activities"]))
+        if self.user_stats_enabled():
+            modes = Counter()
+            for stats in self.iter_user_stats(["transportation_modes"]):
+                modes.update(stats["transportation_modes"])
+            for mode, count in modes.most_common():
+                yield ModeActivities(mode, count)
+            return
+
+        transportation_modes_in_activites = self.aggregate(self.activities_collection, [transportation_not_null, group_transportation, sort_by_count])
+        for transport in transportation_modes_in_activites:
+            yield ModeActivities(transport["_id"], transport["activity_count"])
 
-    def query_six(self):
+    def iter_query_six(self):
         """
         For the grouping by year we only consider the start_date_time of activities.
 
@@ -89,9 +267,20 @@ class Queries:
         The duration is calculated by subtracting the start_date_time from the end_date_time and converting ms to hours
         This is summed for each year.
         """
+        if self.user_stats_enabled():
+            activities_per_year = Counter()
+            hours_per_year = Counter()
+            for stats in self.iter_user_stats(["activities_per_year", "hours_per_year"]):
+                activities_per_year.update(stats["activities_per_year"])
+                hours_per_year.update(stats["hours_per_year"])
+            year_with_most_activities, year_with_most_activities_count = activities_per_year.most_common(1)[0]
+            year_with_most_hours, year_with_most_hours_count = hours_per_year.most_common(1)[0]
+            yield BusiestYears(int(year_with_most_activities), year_with_most_activities_count,
+                               int(year_with_most_hours), year_with_most_hours_count)
+            return
 
         # a)
-        result = self.activities_collection.aggregate([
+        result = self.aggregate(self.activities_collection, [
             {"$group": {"_id": {"$year": "$start_date_time"}, "count": {"$sum": 1}}},
             {"$sort": {"count": -1}},
             {"$limit": 1}
@@ -101,7 +290,7 @@ class Queries:
         year_with_most_activities_count = result[0]['count']
 
         # b)
-        result = self.activities_collection.aggregate([
+        result = self.aggregate(self.activities_collection, [
             {
                 "$project":
                     {
@@ -122,100 +311,173 @@ class Queries:
         result = list(result)
         year_with_most_hours = result[0]['_id']
         year_with_most_hours_count = result[0]['total_hours']
-        is_same_year = year_with_most_hours == year_with_most_activities
-
-        print(f"Year with most activities: {year_with_most_activities} ({year_with_most_activities_count})")
-        print(f"Year with most hours: {year_with_most_hours} ({year_with_most_hours_count:.2f})")
-        print(f"Is the year with most activities the same as the year with most hours? {is_same_year}")
-
-    """Find the total distance (in km) walked in 2008, by user with id=112."""
-    def query_seven(self):
-        filter = { 
-            "$match": {
-                "user_id": {"$eq": "112"}, 
-                "transportation_mode": {"$eq": "walk"}, 
-                "start_date_time": {"$gte": datetime(2008, 1, 1), "$lt": datetime(2009, 1, 1)},
-                "end_date_time": {"$gte": datetime(2008, 1, 1), "$lt": datetime(2009, 1, 1)}
-            } 
+        yield BusiestYears(year_with_most_activities, year_with_most_activities_count,
+                           year_with_most_hours, year_with_most_hours_count)
+
+    def iter_query_seven(self, user_id="112", transportation_mode="walk", start_year=2008, end_year=2008, batch_size=None):
+        """
+        Find the total distance (in km) walked in 2008, by user with id=112.
+
+        The user, transportation mode and (inclusive) year range can be changed. The trackpoints of all
+        matching activities are fetched with one projected cursor sorted by activity and time, and the
+        distances between consecutive points of each activity are computed with a vectorized haversine.
+        """
+        start, end = datetime(start_year, 1, 1), datetime(end_year + 1, 1, 1)
+        filter = {
+            "user_id": {"$eq": user_id},
+            "transportation_mode": {"$eq": transportation_mode},
+            "start_date_time": {"$gte": start, "$lt": end},
+            "end_date_time": {"$gte": start, "$lt": end}
         }
 
-        activities = self.activities_collection.aggregate([filter])
+        if self.summaries_enabled():
+            result = list(self.aggregate(self.activities_collection, [
+                {"$match": filter},
+                {"$group": {"_id": None, "total_distance": {"$sum": "$distance_km"}}}
+            ]))
+            total_distance = result[0]["total_distance"] if result else 0
+            yield Distance(user_id, transportation_mode, start_year, end_year, total_distance)
+            return
+
+        activity_ids = [activity["_id"] for activity in self.find(self.activities_collection, filter, {"_id": 1})]
+
         total_distance = 0
+        for _, _, points in self.iter_activity_points({"activity_id": {"$in": activity_ids}}, ["lat", "lon"], batch_size):
+            lats, lons = points["lat"], points["lon"]
+            total_distance += float(haversine_np(lats[:-1], lons[:-1], lats[1:], lons[1:]).sum())
+
+        yield Distance(user_id, transportation_mode, start_year, end_year, total_distance)
 
-        for activity in activities:
-            trackpoints = list(self.trackpoints_collection.find({"activity_id": activity['_id']}))
-            
-            for i in range(1, len(trackpoints)):
-                trackpoint1 = (trackpoints[i-1]['lat'], trackpoints[i-1]['lon'])
-                trackpoint2 = (trackpoints[i]['lat'], trackpoints[i]['lon'])
-                total_distance += haversine(trackpoint1, trackpoint2)
-        
-        print(f"Total distance walked by user 112 in 2008: {total_distance} km")    
- 
-
-    def query_eight(self):
+    def iter_query_eight(self):
         """
         Find the top 20 users who have gained the most altitude where altidude is not -777.
 
         Activities are grouped by user id and the altitude difference is summed up for each user.
         The altitude difference is multiplied by 0.3048 to convert from feet to meters.
         """
+        if self.user_stats_enabled():
+            result = self.aggregate(self.user_stats_collection, [
+                # Users without activities never show up when the activities are grouped
+                {"$match": {"activity_count": {"$gt": 0}}},
+                {"$project": {"max_altitude_gain": {"$multiply": ["$altitude_gained", 0.3048]}}},
+                {"$sort": {"max_altitude_gain": -1}},
+                {"$limit": 20}
+            ])
+        else:
+            result = self.aggregate(self.activities_collection, [
+                {"$group": {"_id": "$user_id", "max_altitude_gain": {"$sum": {"$multiply": ["$altitude_gained", 0.3048]}}}},
+                {"$sort": {"max_altitude_gain": -1}},
+                {"$limit": 20}
+            ])
+        for line in result:
+            yield AltitudeGain(line["_id"], line["max_altitude_gain"])
+
+    def iter_query_nine(self, batch_size=None):
+        """
+        Find the number of invalid activities per user.
 
-        result = self.activities_collection.aggregate([
-            {"$group": {"_id": "$user_id", "max_altitude_gain": {"$sum": {"$multiply": ["$altitude_gained", 0.3048]}}}},
-            {"$sort": {"max_altitude_gain": -1}},
-            {"$limit": 20}
-        ])
-        result = list(result)
-        print("Top 20 users who have gained the most altitude")
-        table = [(line["_id"], round(line["max_altitude_gain"], 4)) for line in result]
-        print(tabulate(table, headers=["User", "Altitude gain"]))
-
-    def query_nine(self):
-        data = list(self.trackpoints_collection.find())
-        df = pd.DataFrame(data)
-
-        df["time_diff"] = df.groupby("activity_id")["date_from"].diff()
-
-        df["invalid"] = df["time_diff"] > pd.Timedelta(minutes=5)
-
-        result = df[df['invalid']].groupby('user_id')['activity_id'].nunique().reset_index()
-        result.columns = ["UserId", "InvalidActivities"]
-        pd.set_option('display.max_rows', None)
-        print(result)
-    
-
-    def query_ten(self):
+        An activity is invalid if two consecutive trackpoints are more than 5 minutes apart.
+        The trackpoints are streamed sorted by activity and time with only the fields that are needed,
+        so only the points of the current activity are kept in memory.
+        With summaries the largest gap stored on each activity is used instead.
+        """
+        if self.summaries_enabled():
+            result = self.aggregate(self.activities_collection, [
+                {"$match": {"max_gap_seconds": {"$gt": 5 * 60}}},
+                {"$group": {"_id": "$user_id", "invalid_activities": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ])
+            for line in result:
+                yield InvalidActivities(line["_id"], line["invalid_activities"])
+            return
+
+        max_gap = np.timedelta64(5, "m")
+        invalid_activities = Counter()
+
+        for _, user_id, points in self.iter_activity_points({}, ["date_from"], batch_size):
+            if (np.diff(points["date_from"]) > max_gap).any():
+                invalid_activities[user_id] += 1
+
+        for user_id, count in sorted(invalid_activities.items()):
+            yield InvalidActivities(user_id, count)
+
+    def iter_query_ten(self, min_lat=39.916, min_lon=116.397, max_lat=39.917, max_lon=116.398, polygon=None, geo_within=None):
         """
         Find the users who have tracked an activity in the Forbidden City of Beijing.
 
         For this task we assume that the Forbidden City is the area between the following coordinates,
         where the area is defined by higher precision coordinates: lat 39.916, lon 116.397.
-        """
 
-        result = self.trackpoints_collection.aggregate(
+        Any other region can be given as a bounding box or as a polygon of (lon, lat) pairs.
+        With geo_within the region is matched with $geoWithin on the 2dsphere-indexed location field,
+        otherwise with plain range filters on lat and lon. geo_within=None uses $geoWithin only if the
+        trackpoints have the location field, see locations_enabled. $geoWithin includes points on the edges
+        of the region, while the range filters (like the original query) leave out the points on max_lat and max_lon.
+        With summaries only the trackpoints of activities whose bounding box overlaps the region are searched.
+        With the bucket layout the buckets whose bounding box overlaps the region are decoded and filtered here.
+        """
+        if self.trackpoint_layout == "buckets":
+            yield from self.iter_query_ten_buckets(min_lat, min_lon, max_lat, max_lon, polygon)
+            return
+
+        if geo_within is None:
+            geo_within = self.locations_enabled()
+        if polygon is not None and not geo_within:
+            raise ValueError("Polygon regions need the location field, the trackpoints only have lat and lon")
+        match = region_filter(min_lat, min_lon, max_lat, max_lon, polygon, geo_within)
+
+        if self.summaries_enabled():
+            if polygon is not None:
+                min_lon, max_lon = min(lon for lon, _ in polygon), max(lon for lon, _ in polygon)
+                min_lat, max_lat = min(lat for _, lat in polygon), max(lat for _, lat in polygon)
+            candidates = self.find(self.activities_collection, {
+                "bounding_box.min_lat": {"$lte": max_lat},
+                "bounding_box.max_lat": {"$gte": min_lat},
+                "bounding_box.min_lon": {"$lte": max_lon},
+                "bounding_box.max_lon": {"$gte": min_lon},
+            }, {"_id": 1})
+            match["activity_id"] = {"$in": [activity["_id"] for activity in candidates]}
+
+        result = self.aggregate(self.trackpoints_collection,
             [
-                {
-                    "$match": {
-                        "$expr": {
-                            "$and": [
-                                {"$gte": ["$lat", 39.916]},
-                                {"$lt": ["$lat", 39.917]},
-                                {"$gte": ["$lon", 116.397]},
-                                {"$lt": ["$lon", 116.398]},
-                            ]
-                        }
-                    }
-                },
+                {"$match": match},
                 {"$group": {"_id": "$user_id"}},
+                {"$sort": {"_id": 1}},
             ]
         )
 
-        result = list(result)
-
-        print(tabulate([[line["_id"]] for line in result], headers=["Users"]))
-
-    def query_eleven(self):
+        for line in result:
+            yield RegionUser(line["_id"])
+
+    def iter_query_ten_buckets(self, min_lat, min_lon, max_lat, max_lon, polygon=None):
+        if polygon is not None:
+            min_lon, max_lon = min(lon for lon, _ in polygon), max(lon for lon, _ in polygon)
+            min_lat, max_lat = min(lat for _, lat in polygon), max(lat for _, lat in polygon)
+
+        buckets = self.find(self.buckets_collection, {
+            "min_lat": {"$lte": max_lat},
+            "max_lat": {"$gte": min_lat},
+            "min_lon": {"$lte": max_lon},
+            "max_lon": {"$gte": min_lon},
+        }, {"_id": 0, "user_id": 1, "packed": 1, "lat": 1, "lon": 1})
+
+        users = set()
+        for bucket in buckets:
+            if bucket["user_id"] in users:
+                continue
+            points = decode_bucket(bucket)
+            lats, lons = points["lat"], points["lon"]
+            if polygon is not None:
+                inside = points_in_polygon(lats, lons, polygon)
+            else:
+                inside = (lats >= min_lat) & (lats < max_lat) & (lons >= min_lon) & (lons < max_lon)
+            if inside.any():
+                users.add(bucket["user_id"])
+
+        for user in sorted(users):
+            yield RegionUser(user)
+
+    def iter_query_eleven(self):
         """
         Find all users who have registered transportation_mode and their most used transportation_mode.
 
@@ -223,7 +485,16 @@ class Queries:
         Then group by user_id and transportation_mode and count the number of activities for each user and transportation_mode.
         Then group by user_id and find the transportation_mode with the highest count for each user.
         """
-        result = self.activities_collection.aggregate([
+        if self.user_stats_enabled():
+            for stats in self.iter_user_stats(["transportation_modes"]).sort("_id", 1):
+                if not stats["transportation_modes"]:
+                    continue
+                # Same tie-break as $max over {max, mode}: the highest count, then the greatest mode name
+                count, mode = max((count, mode) for mode, count in stats["transportation_modes"].items())
+                yield MostUsedMode(stats["_id"], mode, count)
+            return
+
+        result = self.aggregate(self.activities_collection, [
             {
                 "$match": {
                     "transportation_mode": {
@@ -260,11 +531,8 @@ class Queries:
             },
         ])
 
-        result = list(result)
-        table = [(line["_id"], line["most_used_transportation_mode"]["mode"], line["most_used_transportation_mode"]["max"]) for line in result]
-
-        print("Users who have registered transportation_mode and their most used transportation_mode")
-        print(tabulate(table, headers=["User", "Mode", "Count"]))
+        for line in result:
+            yield MostUsedMode(line["_id"], line["most_used_transportation_mode"]["mode"], line["most_used_transportation_mode"]["max"])
 
     def query_print_samples(self):
         user = self.users_collection.find_one()
@@ -275,44 +543,109 @@ class Queries:
         print("\nInstance of Activity")
         pprint(activity)
 
-        trackpoint = self.trackpoints_collection.find_one({"activity_id": activity["_id"]})
+        if self.trackpoint_layout == "buckets":
+            trackpoint = self.buckets_collection.find_one({"activity_id": activity["_id"]})
+        else:
+            trackpoint = self.trackpoints_collection.find_one({"activity_id": activity["_id"]})
         print("\nInstance of Trackpoint")
         pprint(trackpoint)
 
-def main(query):
+# Query numbers accepted by -query and the Queries method they run
+QUERY_METHODS = {
+    1: "query_one",
+    2: "query_two",
+    3: "query_three",
+    4: "query_four",
+    5: "query_five",
+    6: "query_six",
+    7: "query_seven",
+    8: "query_eight",
+    9: "query_nine",
+    10: "query_ten",
+    11: "query_eleven",
+    13: "query_print_samples",
+}
+
+
+# Values of the auto/yes/no options of the CLI
+OPTION_CHOICES = {"auto": None, "yes": True, "no": False}
+
+
+def parse_queries(query):
+    """Turn the -query argument ("all", "7" or "1,2,3") into a list of query numbers."""
+    if query == "all":
+        return [number for number in QUERY_METHODS if number != 13]
+    return [int(number) for number in str(query).split(",")]
+
+
+def run_query(program, db_connector, number, capture=True):
+    """
+    Run one query and return its printed output and wall time. db_connector is None for LocalQueries.
+
+    With capture=False the output goes straight to stdout and None is returned for it.
+    """
+    with capture_output() if capture else nullcontext() as buffer:
+        start = time.perf_counter()
+        try:
+            with db_connector.track(f"query {number}") if db_connector is not None else nullcontext():
+                getattr(program, QUERY_METHODS[number])()
+        except Exception as e:
+            print("ERROR: Failed to run query:", e)
+        seconds = time.perf_counter() - start
+    return buffer.getvalue() if capture else None, seconds
+
+
+def run_queries(program, db_connector, numbers, max_workers=None):
+    """
+    Run independent queries concurrently on a thread pool that shares one pooled client.
+
+    The output of every query is collected separately and printed in the requested order,
+    followed by a table with the time each query took. Because of that, the whole output of a query
+    is held in memory. With max_workers=1 the queries run one after another instead and print their
+    rows straight to stdout as they stream in.
+    """
+    start = time.perf_counter()
+    timings = []
+    if max_workers == 1:
+        for number in numbers:
+            print(f"\n=== Query {number} ===")
+            _, seconds = run_query(program, db_connector, number, capture=False)
+            timings.append((number, QUERY_METHODS[number], seconds))
+    else:
+        # Connect before the threads start, so the connection message is printed once and not into one query's output
+        db_connector.client
+        with ThreadPoolExecutor(max_workers=max_workers or len(numbers)) as executor:
+            futures = [(number, executor.submit(run_query, program, db_connector, number)) for number in numbers]
+            for number, future in futures:
+                output, seconds = future.result()
+                print(f"\n=== Query {number} ===")
+                print(output, end="")
+                timings.append((number, QUERY_METHODS[number], seconds))
+
+    print()
+    print(tabulate(timings, headers=["Query", "Method", "Seconds"], floatfmt=".3f"))
+    print(f"Total wall time: {time.perf_counter() - start:.3f} s")
+
+
+def main(query, trackpoint_layout="points", instrument=False, explain=False, cache=False, batch_size=10000, allow_disk_use=True,
+         use_summaries=None, use_user_stats=None, max_workers=None):
     program = None
     try:
-        db_connector = DbConnector(DATABASE="my_db", HOST="tdt4225-21.idi.ntnu.no", USER="mongo", PASSWORD="mongo")
-
-        program = Queries(db_connector)
-
-        # cleanly run queries based on argument
-        if query == 1:
-            program.query_one()
-        elif query == 2:
-            program.query_two()
-        elif query == 3:
-            program.query_three()
-        elif query == 4:
-            program.query_four()
-        elif query == 5:
-            program.query_five()
-        elif query == 6:
-            program.query_six()
-        elif query == 7:
-            program.query_seven()
-        elif query == 8:
-            program.query_eight()
-        elif query == 9:
-            program.query_nine()
-        elif query == 10:
-            program.query_ten()
-        elif query == 11:
-            program.query_eleven()
-        elif query == 13:
-            program.query_print_samples()
-        else:
+        db_connector = DbConnector(instrument=instrument, explain=explain, lazy=True)
+
+        program = Queries(db_connector, trackpoint_layout=trackpoint_layout, batch_size=batch_size, allow_disk_use=allow_disk_use,
+                          use_summaries=use_summaries, use_user_stats=use_user_stats)
+        if cache:
+            program = CachedQueries(program)
+
+        numbers = parse_queries(query)
+        if any(number not in QUERY_METHODS for number in numbers):
             print("ERROR: Invalid query number")
+        elif len(numbers) == 1:
+            with db_connector.track(f"query {numbers[0]}"):
+                getattr(program, QUERY_METHODS[numbers[0]])()
+        else:
+            run_queries(program, db_connector, numbers, max_workers)
 
     except Exception as e:
         print("ERROR: Failed to use database:", e)
@@ -324,6 +657,19 @@ def main(query):
 if __name__ == '__main__':
     # Use args to be able to choose which query you want to run
     parser = argparse.ArgumentParser(description="Choose query")
-    parser.add_argument("-query", type=int, help="Choose query")
+    parser.add_argument("-query", default="all", help="Choose query: a number, a comma separated list or all")
+    parser.add_argument("-layout", choices=["points", "buckets"], default="points", help="How trackpoints are stored")
+    parser.add_argument("-instrument", action="store_true", help="Record every database command and print a summary")
+    parser.add_argument("-explain", action="store_true", help="Capture the query plans and flag collection scans")
+    parser.add_argument("-cache", action="store_true", help="Reuse query results until the next ingest")
+    parser.add_argument("-batch-size", type=int, default=10000, help="Number of documents fetched per cursor round trip")
+    parser.add_argument("-no-disk-use", action="store_true", help="Do not let aggregations spill to disk on the server")
+    parser.add_argument("-summaries", choices=["auto", "yes", "no"], default="auto",
+                        help="Answer queries 7, 9 and 10 from the activity summaries (auto: if every activity has one)")
+    parser.add_argument("-user-stats", choices=["auto", "yes", "no"], default="auto",
+                        help="Answer queries 2, 3, 5, 6, 8 and 11 from user_stats (auto: if it covers every activity)")
+    parser.add_argument("-workers", type=int, default=None,
+                        help="Number of queries run at once (default: all). With 1 the rows are printed as they stream in")
     args = parser.parse_args()
-    main(args.query)
+    main(args.query, args.layout, args.instrument, args.explain, args.cache, args.batch_size, not args.no_disk_use,
+         OPTION_CHOICES[args.summaries], OPTION_CHOICES[args.user_stats], args.workers)
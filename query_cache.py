@@ -0,0 +1,107 @@
+from datetime import datetime
+
+import bson
+
+from query_rows import ROW_TYPES, QueryPrinter
+
+# Document in the metadata collection that DataLoader bumps whenever the data changes
+DATASET_VERSION_ID = "dataset_version"
+
+
+def get_dataset_version(db):
+    marker = db["metadata"].find_one({"_id": DATASET_VERSION_ID})
+    return marker["version"] if marker else 0
+
+
+def bump_dataset_version(db):
+    """Mark the dataset as changed, which invalidates every cached query result."""
+    db["metadata"].update_one({"_id": DATASET_VERSION_ID},
+                              {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now()}},
+                              upsert=True)
+
+
+class QueryCache:
+    """
+    Stores query results in the query_cache collection, keyed by query name and parameters.
+
+    A result is stored as a list of rows, each a [row type name, values] pair. Entries are only valid for the
+    dataset version they were computed for; entries of older versions are removed the first time the new
+    version is seen. When the cached results grow past max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, db, max_bytes=64 * 1024 * 1024):
+        self.db = db
+        self.collection = db["query_cache"]
+        self.max_bytes = max_bytes
+        self.version = None
+
+    def current_version(self):
+        version = get_dataset_version(self.db)
+        if version != self.version:
+            self.collection.delete_many({"version": {"$ne": version}})
+            self.version = version
+        return version
+
+    def get(self, key, version):
+        """Return the cached rows for key, or None if there are none for this version."""
+        entry = self.collection.find_one_and_update(
+            {"_id": key, "version": version},
+            {"$set": {"last_used": datetime.now()}})
+        if entry is None:
+            return None
+        return [ROW_TYPES[row_type](*values) for row_type, values in entry["rows"]]
+
+    def put(self, key, rows, version):
+        # The version is read before the query runs, so rows computed during an ingest are never stored as current
+        stored_rows = [[type(row).__name__, list(row)] for row in rows]
+        self.collection.replace_one({"_id": key}, {
+            "version": version,
+            "rows": stored_rows,
+            "size": len(bson.encode({"rows": stored_rows})),
+            "last_used": datetime.now(),
+        }, upsert=True)
+        self.evict()
+
+    def evict(self):
+        total = sum(entry["size"] for entry in self.collection.find({}, {"size": 1}))
+        if total <= self.max_bytes:
+            return
+        for entry in self.collection.find({}, {"size": 1}).sort("last_used", 1):
+            self.collection.delete_one({"_id": entry["_id"]})
+            total -= entry["size"]
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        self.collection.delete_many({})
+
+
+class CachedQueries(QueryPrinter):
+    """
+    Wraps a Queries instance so that repeated iter_query_* calls return their cached rows instead of hitting the database.
+
+    The query_* methods print the rows of the cached iter_query_* methods. A result that is not cached yet
+    is read completely before it is returned, so it can be stored. Everything else is passed through to
+    the wrapped instance.
+    """
+
+    def __init__(self, queries, cache=None):
+        self.queries = queries
+        self.cache = cache or QueryCache(queries.db)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.queries, name)
+        if not name.startswith("iter_query_") or not callable(attribute):
+            return attribute
+
+        def cached_query(*args, **kwargs):
+            key = repr((name, args, sorted(kwargs.items()), self.queries.summaries_enabled(),
+                        self.queries.user_stats_enabled(), self.queries.locations_enabled(), self.queries.trackpoint_layout))
+            version = self.cache.current_version()
+            rows = self.cache.get(key, version)
+            if rows is None:
+                rows = list(attribute(*args, **kwargs))
+                self.cache.put(key, rows, version)
+            return iter(rows)
+
+        return cached_query
@@ -0,0 +1,134 @@
+from typing import NamedTuple
+
+from output import print_table
+
+# The rows yielded by the iter_query_* methods of Queries and LocalQueries
+
+
+class CollectionCount(NamedTuple):
+    collection: str
+    count: int
+
+
+class AverageActivities(NamedTuple):
+    average: float
+
+
+class UserActivities(NamedTuple):
+    user: str
+    activities: int
+
+
+class TaxiUser(NamedTuple):
+    user: str
+
+
+class ModeActivities(NamedTuple):
+    transportation_mode: str
+    activities: int
+
+
+class BusiestYears(NamedTuple):
+    year_with_most_activities: int
+    activities: int
+    year_with_most_hours: int
+    hours: float
+
+
+class Distance(NamedTuple):
+    user: str
+    transportation_mode: str
+    start_year: int
+    end_year: int
+    distance_km: float
+
+
+class AltitudeGain(NamedTuple):
+    user: str
+    altitude_gain: float
+
+
+class InvalidActivities(NamedTuple):
+    user: str
+    invalid_activities: int
+
+
+class RegionUser(NamedTuple):
+    user: str
+
+
+class MostUsedMode(NamedTuple):
+    user: str
+    transportation_mode: str
+    activities: int
+
+
+# Every row type by name, to turn stored rows back into rows
+ROW_TYPES = {row_type.__name__: row_type for row_type in [
+    CollectionCount, AverageActivities, UserActivities, TaxiUser, ModeActivities, BusiestYears, Distance,
+    AltitudeGain, InvalidActivities, RegionUser, MostUsedMode,
+]}
+
+
+class QueryPrinter:
+    """
+    The query_* methods of the CLI. Each one prints the rows of the matching iter_query_* method.
+
+    Rows are printed while they are read, in tables of at most print_rows rows, so a long result is
+    never held in memory.
+    """
+    print_rows = 1000
+
+    def query_one(self):
+        """How many users, activities and trackpoints are there in the dataset"""
+        print_table(self.iter_query_one(), ["Collection", "Count"], self.print_rows)
+
+    def query_two(self):
+        """Find the average number of activities per user."""
+        for row in self.iter_query_two():
+            print(f"Average number of activities per user: {row.average :.2f}")
+
+    def query_three(self):
+        """Find the top 20 users with the highest number of activities."""
+        print_table(self.iter_query_three(), ["User", "Number of activities"], self.print_rows)
+
+    def query_four(self):
+        """Find all users who have taken a taxi."""
+        print_table(self.iter_query_four(), ["All users who have taken a taxi"], self.print_rows)
+
+    def query_five(self):
+        """Count the activities per transportation mode."""
+        print_table(self.iter_query_five(), ["Transportation mode", "Number of activities"], self.print_rows)
+
+    def query_six(self):
+        """Find the year with the most activities and whether it is also the year with the most recorded hours."""
+        for row in self.iter_query_six():
+            is_same_year = row.year_with_most_hours == row.year_with_most_activities
+
+            print(f"Year with most activities: {row.year_with_most_activities} ({row.activities})")
+            print(f"Year with most hours: {row.year_with_most_hours} ({row.hours:.2f})")
+            print(f"Is the year with most activities the same as the year with most hours? {is_same_year}")
+
+    def query_seven(self, *args, **kwargs):
+        """Find the total distance (in km) walked in 2008, by user with id=112."""
+        for row in self.iter_query_seven(*args, **kwargs):
+            print(f"Total distance ({row.transportation_mode}) by user {row.user} in {row.start_year}-{row.end_year}: {row.distance_km} km")
+
+    def query_eight(self):
+        """Find the top 20 users who have gained the most altitude."""
+        print("Top 20 users who have gained the most altitude")
+        rows = ((row.user, round(row.altitude_gain, 4)) for row in self.iter_query_eight())
+        print_table(rows, ["User", "Altitude gain"], self.print_rows)
+
+    def query_nine(self, *args, **kwargs):
+        """Find the number of invalid activities per user."""
+        print_table(self.iter_query_nine(*args, **kwargs), ["UserId", "InvalidActivities"], self.print_rows)
+
+    def query_ten(self, *args, **kwargs):
+        """Find the users who have tracked an activity in the Forbidden City of Beijing."""
+        print_table(self.iter_query_ten(*args, **kwargs), ["Users"], self.print_rows)
+
+    def query_eleven(self):
+        """Find all users who have registered transportation_mode and their most used transportation_mode."""
+        print("Users who have registered transportation_mode and their most used transportation_mode")
+        print_table(self.iter_query_eleven(), ["User", "Mode", "Count"], self.print_rows)
@@ -0,0 +1,88 @@
+import numpy as np
+
+from queries import EARTH_RADIUS
+
+
+def project(lats, lons):
+    """Project coordinates in degrees to meters on a plane through the first point (equirectangular)."""
+    lats, lons = np.radians(lats), np.radians(lons)
+    x = (lons - lons[0]) * np.cos(lats[0]) * EARTH_RADIUS * 1000
+    y = (lats - lats[0]) * EARTH_RADIUS * 1000
+    return x, y
+
+
+def segment_distances(x, y, first, last):
+    """Distances of the points between first and last to the segment from first to last."""
+    dx, dy = x[last] - x[first], y[last] - y[first]
+    px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+    length = dx * dx + dy * dy
+    if length == 0:
+        return np.hypot(px, py)
+    t = np.clip((px * dx + py * dy) / length, 0, 1)
+    return np.hypot(px - t * dx, py - t * dy)
+
+
+def douglas_peucker(x, y, tolerance):
+    """Return a mask of the points Douglas-Peucker keeps, so no point is further than tolerance from the simplified line."""
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    # An explicit stack, long activities would hit the recursion limit
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(x, y, first, last)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack += [(first, split), (split, last)]
+    return keep
+
+
+def gap_points(times, max_gap):
+    """
+    Return a mask of points so that consecutive masked points are at most max_gap apart, where the trajectory allows it.
+
+    Walking from the first point, the furthest point within max_gap is taken each time. Where the next
+    point is already further than max_gap away both sides of that gap are taken, so the gap stays as it is.
+    """
+    keep = np.zeros(len(times), dtype=bool)
+    keep[-1] = True
+    current = 0
+    while current < len(times) - 1:
+        keep[current] = True
+        furthest = int(np.searchsorted(times, times[current] + max_gap, side="right")) - 1
+        current = max(furthest, current + 1)
+    return keep
+
+
+def simplify_track(lats, lons, tolerance, max_points, times=None, max_gap=None):
+    """
+    Return the indexes of the points to keep of a trajectory, at most max_points of them.
+
+    The trajectory is simplified with Douglas-Peucker using tolerance in meters. If that still keeps more
+    than max_points points the tolerance is doubled until it does not. The first and last points are always kept,
+    so max_points has to be at least 2.
+
+    With times (in seconds) and max_gap the simplified trajectory has a step longer than max_gap exactly where the
+    original has one, since the points of gap_points are always kept. If those alone are more than max_points,
+    all of them are returned.
+    """
+    if max_points < 2:
+        raise ValueError(f"A simplified trajectory keeps at least its first and last points, max_points={max_points} is too small")
+    if len(lats) <= max_points:
+        return np.arange(len(lats))
+
+    required = np.zeros(len(lats), dtype=bool)
+    if times is not None and max_gap is not None:
+        required = gap_points(np.asarray(times, dtype=float), max_gap)
+
+    x, y = project(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+    keep = douglas_peucker(x, y, tolerance) | required
+    # Douglas-Peucker keeps only the endpoints eventually, so this stops at the required points
+    while keep.sum() > max(max_points, required.sum()):
+        tolerance = tolerance * 2 if tolerance > 0 else 1.0
+        keep = douglas_peucker(x, y, tolerance) | required
+    return np.flatnonzero(keep)